@@ -0,0 +1,88 @@
+import os
+from typing import Dict, Optional, Tuple
+
+from render import Render
+from scratch import BYTES_PER_MESSAGE
+
+# Rough memory a render holds while it's waiting: the render and its feedback message,
+# then every message's Comment besides its text
+RENDER_MEMORY = 50000
+MESSAGE_MEMORY = 1500
+# Used before the messages are fetched
+AVERAGE_CHARACTERS = 100
+
+
+class AdmissionController:
+    """
+    Keeps the estimated memory and disk cost of every render from the moment it's queued until
+    it's done, and tells whether a new one still fits under maxMemory and maxDisk bytes (0 for
+    no limit). Disk is the video reserved in scratch.ScratchSpace plus the evidence files the
+    render uses. A render always fits when nothing else is queued, so the limits can't block
+    the bot for good.
+    """
+
+    def __init__(self, maxMemory: int = 0, maxDisk: int = 0):
+        self.maxMemory = maxMemory
+        self.maxDisk = maxDisk
+        self.costs = {}  # job id -> (memory, disk)
+        self.memory = 0
+        self.disk = 0
+
+    def estimate(self, messageCount: int, characters: Optional[int] = None, evidenceBytes: int = 0):
+        # Returns (memory, disk) in bytes
+        if characters is None:
+            characters = messageCount * AVERAGE_CHARACTERS
+        memory = RENDER_MEMORY + messageCount * MESSAGE_MEMORY + characters
+        return memory, messageCount * BYTES_PER_MESSAGE + evidenceBytes
+
+    def getCost(self, render: Render):
+        comments = render.getMessages()
+        evidenceBytes = 0
+        for comment in comments:
+            if comment.evidence_path is not None:
+                try:
+                    evidenceBytes += os.path.getsize(comment.evidence_path)
+                except OSError:
+                    pass
+        return self.estimate(
+            len(comments), sum(len(comment.text_content) for comment in comments), evidenceBytes
+        )
+
+    def fits(self, memory: int, disk: int, freedMemory: int = 0, freedDisk: int = 0):
+        if not self.costs or (freedMemory >= self.memory and freedDisk >= self.disk):
+            return True
+        if self.maxMemory and self.memory - freedMemory + memory > self.maxMemory:
+            return False
+        if self.maxDisk and self.disk - freedDisk + disk > self.maxDisk:
+            return False
+        return True
+
+    def getWait(self, memory: int, disk: int, finishTimes: Dict[int, float]):
+        # Seconds until enough renders are done for a new one to fit, finishTimes maps the job
+        # ids of the renders in the queue to the seconds until they're expected to be done
+        freedMemory = freedDisk = 0
+        for jobId, seconds in sorted(finishTimes.items(), key=lambda item: item[1]):
+            cost = self.costs.get(jobId)
+            if cost is None:
+                continue
+            freedMemory += cost[0]
+            freedDisk += cost[1]
+            if self.fits(memory, disk, freedMemory, freedDisk):
+                return seconds
+        return max(finishTimes.values(), default=0.0)
+
+    def add(self, render: Render, cost: Tuple[int, int]):
+        memory, disk = cost
+        self.remove(render.get_id())
+        self.costs[render.get_id()] = (memory, disk)
+        self.memory += memory
+        self.disk += disk
+
+    def remove(self, jobId: int):
+        cost = self.costs.pop(jobId, None)
+        if cost is not None:
+            self.memory -= cost[0]
+            self.disk -= cost[1]
+
+    def __len__(self):
+        return len(self.costs)
@@ -0,0 +1,307 @@
+import hashlib
+import importlib.util
+import json
+import mmap
+import os
+import re
+import struct
+
+from PIL import Image, ImagePalette
+
+# Pillow maps images of these modes straight onto the file, the others are copied out of it
+MAPPED_MODES = ("L", "P", "RGBA", "RGBX", "CMYK", "I;16")
+HEADER = struct.Struct("<Q")
+# Entries being written, named after the process writing them
+PARTIAL_ENTRY = re.compile(r".+\.(\d+)\.part")
+
+
+def findEngineAssets():
+    # Where the engine's assets can be: it opens them as "assets/..." from the working directory,
+    # and they can also sit next to the installed package or inside it
+    directories = [os.path.abspath("assets")]
+    try:
+        spec = importlib.util.find_spec("objection_engine")
+    except (ImportError, ValueError):
+        spec = None
+    if spec is not None and spec.origin is not None:
+        package = os.path.dirname(os.path.abspath(spec.origin))
+        directories += [os.path.join(package, "assets"), os.path.join(os.path.dirname(package), "assets")]
+    return [directory for directory in dict.fromkeys(directories) if os.path.isdir(directory)]
+
+
+def isRunning(pid: int):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def encodeValue(value):
+    # Image info values as JSON, transparency can be bytes for palette images. None for the
+    # types JSON can't hold, which are dropped
+    if isinstance(value, bytes):
+        return {"bytes": value.hex()}
+    if isinstance(value, tuple):
+        items = [encodeValue(item) for item in value]
+        return None if None in items else {"tuple": items}
+    if isinstance(value, (int, float, str)):
+        return value
+    return None
+
+
+def decodeValue(value):
+    if isinstance(value, dict) and "bytes" in value:
+        return bytes.fromhex(value["bytes"])
+    if isinstance(value, dict) and "tuple" in value:
+        return tuple(decodeValue(item) for item in value["tuple"])
+    return value
+
+
+def encodeInfo(info: dict):
+    encoded = {key: encodeValue(value) for key, value in info.items()}
+    return {key: value for key, value in encoded.items() if value is not None}
+
+
+def decodeInfo(encoded: dict):
+    return {key: decodeValue(value) for key, value in encoded.items()}
+
+
+class SharedAnimation:
+    # Stands for an animated image returned by Image.open, with its frames already decoded
+    is_animated = True
+
+    def __init__(self, frames, format: str, info: dict):
+        self.frames = frames
+        self.frame = 0
+        self.format = format
+        self.info = info
+
+    @property
+    def n_frames(self):
+        return len(self.frames)
+
+    def seek(self, frame: int):
+        if not 0 <= frame < len(self.frames):
+            raise EOFError("no more images in file")
+        self.frame = frame
+
+    def tell(self):
+        return self.frame
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def __getattr__(self, name):
+        return getattr(self.frames[self.frame], name)
+
+
+class AssetStore:
+    """
+    Decoded engine assets shared by every render worker of a machine. The first worker that opens
+    an image or a sound from the engine's assets directory decodes it and writes its pixels or
+    samples to a file in directory, which is best on a tmpfs such as /dev/shm. From then on every
+    worker maps that file read-only: nothing is decoded again, and the pages are shared between
+    workers instead of each of them holding its own copy.
+    Images come back backed by the mapping itself. Sounds are copied out of it, pydub only takes
+    bytes, which still spares ffmpeg decoding the same music for every render.
+    Entries are named after the asset's path, size and modification time, so changed assets are
+    decoded again. The engine's assets directories are found from the working directory and the
+    installed package unless assetsDirectories is given.
+    """
+
+    def __init__(self, directory: str, assetsDirectories: list = None):
+        self.directory = os.path.abspath(directory)
+        # Found on first use by default, the engine downloads its assets when it's imported
+        self.assetsDirectories = assetsDirectories
+        self.entries = {}  # entry path -> (metadata, memoryview of its data)
+        # Assets opened through the store, the store does nothing if it stays at 0
+        self.hits = 0
+        self.reported = False
+        os.makedirs(self.directory, exist_ok=True)
+        self.sweep()
+
+    def sweep(self):
+        # Removes the entries left half written by workers that died while writing them
+        for name in os.listdir(self.directory):
+            match = PARTIAL_ENTRY.fullmatch(name)
+            if match and not isRunning(int(match.group(1))):
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError as exception:
+                    print(f"Error: {exception}")
+
+    def covers(self, path):
+        if not isinstance(path, (str, os.PathLike)):
+            return False
+        if not self.assetsDirectories:
+            # Looked for again until they're there
+            self.assetsDirectories = findEngineAssets()
+        path = os.path.abspath(path)
+        return any(path.startswith(os.path.abspath(directory) + os.sep) for directory in self.assetsDirectories)
+
+    def checkUsed(self):
+        # Called after a render, tells once if none of the engine's assets went through the store
+        if self.hits == 0 and not self.reported:
+            self.reported = True
+            print(
+                "Error: no engine asset was opened from "
+                f"{', '.join(self.assetsDirectories or []) or 'any known directory'}, "
+                "render workers aren't sharing them"
+            )
+
+    def getEntryPath(self, path, kind: str):
+        stat = os.stat(path)
+        name = f"{kind}:{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+        return os.path.join(self.directory, hashlib.sha1(name.encode("utf-8")).hexdigest() + ".asset")
+
+    def read(self, entryPath: str):
+        # Returns (metadata, data) or None if the asset wasn't decoded yet
+        entry = self.entries.get(entryPath)
+        if entry is not None:
+            return entry
+        try:
+            with open(entryPath, "rb") as file:
+                mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return None
+        view = memoryview(mapping)
+        headerLength = HEADER.unpack_from(view)[0]
+        metadata = json.loads(bytes(view[HEADER.size : HEADER.size + headerLength]))
+        entry = self.entries[entryPath] = (metadata, view[HEADER.size + headerLength :])
+        return entry
+
+    def write(self, entryPath: str, metadata: dict, chunks):
+        # Written under a temporary name first, workers decoding the same asset can't clash
+        header = json.dumps(metadata).encode("utf-8")
+        temporaryPath = f"{entryPath}.{os.getpid()}.part"
+        with open(temporaryPath, "wb") as file:
+            file.write(HEADER.pack(len(header)))
+            file.write(header)
+            for chunk in chunks:
+                file.write(chunk)
+        os.replace(temporaryPath, entryPath)
+
+    def saveImage(self, entryPath: str, image):
+        frames = []
+        chunks = []
+        offset = 0
+        for index in range(getattr(image, "n_frames", 1)):
+            image.seek(index)
+            frame = image.copy()
+            data = frame.tobytes()
+            palette = None
+            if frame.mode in ("P", "PA") and frame.palette is not None:
+                palette = [frame.palette.mode, frame.getpalette(frame.palette.mode)]
+            frames.append(
+                {
+                    "mode": frame.mode,
+                    "size": frame.size,
+                    "offset": offset,
+                    "length": len(data),
+                    "palette": palette,
+                    "info": encodeInfo(frame.info),
+                }
+            )
+            chunks.append(data)
+            offset += len(data)
+        image.seek(0)
+        metadata = {
+            "format": image.format,
+            "animated": bool(getattr(image, "is_animated", False)),
+            "info": encodeInfo(image.info),
+            "frames": frames,
+        }
+        self.write(entryPath, metadata, chunks)
+
+    def loadImage(self, metadata: dict, data: memoryview):
+        frames = []
+        for frame in metadata["frames"]:
+            mode, size = frame["mode"], tuple(frame["size"])
+            pixels = data[frame["offset"] : frame["offset"] + frame["length"]]
+            if mode in MAPPED_MODES:
+                image = Image.frombuffer(mode, size, pixels, "raw", mode, 0, 1)
+            else:
+                image = Image.frombytes(mode, size, bytes(pixels))
+            if frame["palette"] is not None:
+                # Set directly, putpalette() would copy the pixels out of the mapping
+                image.palette = ImagePalette.raw(frame["palette"][0], bytes(frame["palette"][1]))
+            image.info = decodeInfo(frame["info"])
+            image.format = metadata["format"]
+            frames.append(image)
+        if metadata["animated"]:
+            return SharedAnimation(frames, metadata["format"], decodeInfo(metadata["info"]))
+        return frames[0]
+
+    def openImage(self, path, openFile):
+        self.hits += 1
+        entryPath = self.getEntryPath(path, "image")
+        entry = self.read(entryPath)
+        if entry is None:
+            with openFile(path) as image:
+                self.saveImage(entryPath, image)
+            entry = self.read(entryPath)
+        return self.loadImage(*entry)
+
+    def loadAudio(self, path, format, fromFile):
+        from pydub import AudioSegment
+
+        self.hits += 1
+        entryPath = self.getEntryPath(path, f"audio:{format}")
+        entry = self.read(entryPath)
+        if entry is None:
+            segment = fromFile(path, format)
+            metadata = {
+                "sample_width": segment.sample_width,
+                "frame_rate": segment.frame_rate,
+                "channels": segment.channels,
+            }
+            self.write(entryPath, metadata, [segment.raw_data])
+            entry = self.read(entryPath)
+        metadata, data = entry
+        return AudioSegment(data=bytes(data), **metadata)
+
+    def install(self):
+        # Called in a render worker before the engine loads anything
+        originalOpen = Image.open
+
+        def open(fp, mode="r", formats=None):
+            if mode == "r" and formats is None and self.covers(fp):
+                try:
+                    return self.openImage(fp, originalOpen)
+                except Exception as exception:
+                    print(f"Error: {exception}")
+            return originalOpen(fp, mode, formats)
+
+        Image.open = open
+
+        try:
+            from pydub import AudioSegment
+        except ImportError:
+            return
+        originalFromFile = AudioSegment.from_file.__func__
+
+        def fromFile(cls, file, format=None, codec=None, parameters=None, start_second=None, duration=None, **kwargs):
+            if (
+                codec is None
+                and parameters is None
+                and start_second is None
+                and duration is None
+                and not kwargs
+                and self.covers(file)
+            ):
+                try:
+                    return self.loadAudio(file, format, lambda path, format: originalFromFile(cls, path, format))
+                except Exception as exception:
+                    print(f"Error: {exception}")
+            return originalFromFile(cls, file, format, codec, parameters, start_second, duration, **kwargs)
+
+        AudioSegment.from_file = classmethod(fromFile)
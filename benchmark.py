@@ -0,0 +1,610 @@
+"""
+Offline benchmark of the bot's pipeline, no Discord token needed.
+
+Discord is replaced by fake interactions, channels and messages, and rendering by a fake
+render_comment_list (sleep or CPU burn) unless --render real is used. Requests go through the
+same admission path as /render, then the queue, the workers, the uploads and the deletions.
+Evidence images are served by a local HTTP server, which also stands in for the external
+upload server: with --size-limit below --video-size every video goes there instead of Discord,
+and --upload-drops makes it drop some uploads so they're retried.
+
+    python benchmark.py --renders 200 --guilds 10 --messages 30 --workers 4
+
+Reports jobs/sec, end-to-end latency percentiles and how late the event loop runs.
+--conversion only times turning a page of history into comments, on 100 and 1000 messages.
+The workload is generated from --seed, so runs with the same arguments can be compared.
+"""
+import argparse
+import asyncio
+import io
+import json
+import multiprocessing
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from functools import partial
+from types import SimpleNamespace
+
+
+def fakeRender(
+    comments,
+    outputFilename,
+    music_code=None,
+    resolution_scale=1,
+    mode="sleep",
+    seconds=0.5,
+    secondsPerMessage=0.02,
+    size=200000,
+):
+    duration = seconds + secondsPerMessage * len(comments) * resolution_scale
+    if mode == "cpu":
+        end = time.process_time() + duration
+        value = 0
+        while time.process_time() < end:
+            value = (value * 31 + 7) % 1000003
+    else:
+        time.sleep(duration)
+    with open(outputFilename, "wb") as file:
+        file.write(b"\0" * size)
+
+
+def runNode(directory, workers, renderFunction):
+    from spool import SpoolNode
+
+    SpoolNode(directory, workers=workers, pollInterval=0.1, renderFunction=renderFunction).run()
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+class FakeApi:
+    # Every Discord call waits this long, a rough stand-in for the API's latency
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls = 0
+
+    async def call(self):
+        self.calls += 1
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+
+
+class FakeUser:
+    def __init__(self, userId: int):
+        self.id = userId
+        self.name = f"User{userId}"
+        self.display_name = self.name
+        self.discriminator = "0000"
+        self.mention = f"<@{userId}>"
+        self.guild_permissions = SimpleNamespace(manage_messages=True)
+
+
+class FakeGuild:
+    def __init__(self, guildId: int):
+        self.id = guildId
+        self.name = f"Guild{guildId}"
+        self.filesize_limit = 25 * 1024 * 1024
+        self.members = {}
+
+    def get_member(self, userId: int):
+        return self.members.get(userId)
+
+
+class FakeMessage:
+    def __init__(self, api, messageId, channel, author, content="", attachments=()):
+        self.api = api
+        self.id = messageId
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author
+        self.content = content
+        self.clean_content = content
+        self.attachments = list(attachments)
+        self.embeds = []
+        self.mentions = []
+        self.reference = None
+        self.created_at = datetime.now(timezone.utc)
+
+    async def add_reaction(self, emoji):
+        await self.api.call()
+
+    async def edit(self, content=None, embed=None, **kwargs):
+        await self.api.call()
+        if content is not None:
+            self.content = content
+        return self
+
+    async def delete(self):
+        await self.api.call()
+        self.channel.deleted += 1
+
+    async def reply(self, **kwargs):
+        return await self.channel.send(**kwargs)
+
+
+class FakeChannel:
+    def __init__(self, api, benchmark, channelId, guild):
+        self.api = api
+        self.benchmark = benchmark
+        self.id = channelId
+        self.name = f"channel{channelId}"
+        self.guild = guild
+        self.history_messages = []  # oldest first
+        self.deleted = 0
+
+    async def history(self, limit=100, oldest_first=False, before=None):
+        await self.api.call()
+        messages = self.history_messages
+        if before is not None:
+            messages = [message for message in messages if message.id < before.id]
+        for message in reversed(messages[-limit:]):
+            yield message
+
+    async def fetch_message(self, messageId):
+        await self.api.call()
+        for message in self.history_messages:
+            if message.id == messageId:
+                return message
+        raise Exception("Unknown message")
+
+    async def send(self, content=None, file=None, embed=None, **kwargs):
+        await self.api.call()
+        if file is not None:
+            # Videos are in a directory named after their job id, the interaction's
+            self.benchmark.finish(int(os.path.basename(os.path.dirname(file.fp.name))))
+            file.close()
+        elif content and self.benchmark.serverUrl in content:
+            # Videos too big for the server are replied to with a link ending in their job id
+            self.benchmark.finish(int(content.split("#")[1].split()[0]))
+        return FakeMessage(self.api, self.benchmark.nextId(), self, self.benchmark.botUser, content or "")
+
+    async def delete_messages(self, messages):
+        await self.api.call()
+        self.deleted += len(messages)
+
+    def get_partial_message(self, messageId):
+        return FakeMessage(self.api, messageId, self, self.benchmark.botUser)
+
+
+class FakeFollowup:
+    def __init__(self, interaction):
+        self.interaction = interaction
+
+    async def send(self, content=None, file=None, embed=None, **kwargs):
+        return await self.interaction.channel.send(content=content, file=file, embed=embed)
+
+
+class FakeInteraction:
+    def __init__(self, benchmark, channel, user):
+        self.id = benchmark.nextId()
+        self.channel = channel
+        self.guild_id = channel.guild.id
+        self.user = user
+        self.created_at = datetime.now(timezone.utc) + timedelta(seconds=1)
+
+        async def defer():
+            await channel.api.call()
+
+        self.response = SimpleNamespace(defer=defer)
+        self.followup = FakeFollowup(self)
+
+
+class Benchmark:
+    def __init__(self, arguments):
+        self.arguments = arguments
+        self.random = random.Random(arguments.seed)
+        self.api = FakeApi(arguments.api_latency)
+        self.lastId = 10**17
+        self.botUser = FakeUser(1)
+        self.started = {}
+        self.finished = {}
+        self.loopLag = []
+        # Called with every message posted, like the bot's on_message
+        self.onMessage = None
+
+    def nextId(self):
+        self.lastId += 1
+        return self.lastId
+
+    def finish(self, interactionId):
+        self.finished[interactionId] = time.perf_counter()
+
+    def createChannels(self, serverUrl):
+        arguments = self.arguments
+        channels = []
+        for guildIndex in range(arguments.guilds):
+            guild = FakeGuild(self.nextId())
+            guild.filesize_limit = arguments.size_limit
+            users = [FakeUser(self.nextId()) for _ in range(arguments.users_per_guild)]
+            for user in users:
+                guild.members[user.id] = user
+            channel = FakeChannel(self.api, self, self.nextId(), guild)
+            # Each render asks for the last --messages messages, new ones are added before every request
+            channel.users = users
+            channels.append(channel)
+        self.serverUrl = serverUrl
+        return channels
+
+    def addMessages(self, channel, count, keep=200):
+        words = [
+            "objection",
+            "hold it",
+            "take that",
+            "witness",
+            "evidence",
+            "the court",
+            "lying",
+            "I see",
+            "https://example.com/proof",
+            "<:thinking:806980920544460831>",
+            "\U0001F914",
+        ]
+        for _ in range(count):
+            attachments = []
+            if self.random.random() < self.arguments.image_ratio:
+                attachmentId = self.nextId()
+                attachments.append(
+                    SimpleNamespace(
+                        id=attachmentId,
+                        filename=f"{attachmentId}.png",
+                        url=f"{self.serverUrl}/{attachmentId}.png",
+                    )
+                )
+            text = " ".join(self.random.choice(words) for _ in range(self.random.randint(3, 20)))
+            message = FakeMessage(
+                self.api,
+                self.nextId(),
+                channel,
+                self.random.choice(channel.users),
+                f"{text} #{self.lastId}",
+                attachments,
+            )
+            channel.history_messages.append(message)
+            if self.onMessage is not None:
+                self.onMessage(message)
+        del channel.history_messages[:-keep]
+
+    async def measureLoopLag(self):
+        interval = 0.01
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(interval)
+            self.loopLag.append(time.perf_counter() - start - interval)
+
+
+async def serveFiles(size: int, dropRatio: float, seed: int):
+    # Serves the evidence images and takes the uploads of videos too big for Discord
+    from aiohttp import web
+
+    from PIL import Image
+
+    # Noise doesn't compress, a photo of about size bytes
+    side = max(1, int((size / 3) ** 0.5))
+    output = io.BytesIO()
+    Image.frombytes("RGB", (side, side), random.Random(0).randbytes(side * side * 3)).save(output, format="PNG")
+    image = output.getvalue()
+
+    async def handleImage(request):
+        return web.Response(body=image, content_type="image/png")
+
+    uploads = SimpleNamespace(completed=0, dropped=0, bytes=0)
+    drops = random.Random(seed)
+
+    async def handleUpload(request):
+        if drops.random() < dropRatio:
+            # The connection is cut before answering, retry() has to send the file again
+            uploads.dropped += 1
+            request.transport.close()
+            return web.Response(status=503)
+        reader = await request.multipart()
+        async for part in reader:
+            while chunk := await part.read_chunk():
+                uploads.bytes += len(chunk)
+        uploads.completed += 1
+        return web.Response(text=f"http://{request.host}/videos/{uploads.completed}.mp4")
+
+    app = web.Application()
+    app.router.add_get("/{name}", handleImage)
+    app.router.add_post("/upload", handleUpload)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    return runner, f"http://127.0.0.1:{port}", uploads
+
+
+async def runBenchmark(arguments):
+    benchmark = Benchmark(arguments)
+    server, serverUrl, uploads = await serveFiles(arguments.image_size, arguments.upload_drops, arguments.seed)
+
+    # Imported here, spawned workers re-import this file and must not load the bot
+    import main
+
+    if not main.loadConfig():
+        raise SystemExit("Invalid benchmark config")
+    from uploader import UguuUploader
+    from worker import RenderPool
+
+    class BenchmarkUploader(UguuUploader):
+        async def upload(self, filename):
+            # The reply only has the link, the job id tells which render it finishes
+            url = await super().upload(filename)
+            return f"{url}#{os.path.basename(os.path.dirname(filename))}"
+
+    main.externalUploader = BenchmarkUploader(url=f"{serverUrl}/upload")
+
+    async def changeActivity(newActivityText):
+        pass
+
+    main.changeActivity = changeActivity
+    renderFunction = None
+    if arguments.render != "real":
+        renderFunction = partial(
+            fakeRender,
+            mode=arguments.render,
+            seconds=arguments.render_seconds,
+            secondsPerMessage=arguments.seconds_per_message,
+            size=arguments.video_size,
+        )
+    nodes = []
+    if arguments.nodes > 0:
+        # Split deployment, renders go through a spool consumed by --nodes node processes
+        from spool import SpoolPool
+
+        directory = os.path.abspath("spool")
+        main.renderPool = SpoolPool(
+            directory,
+            capacity=arguments.nodes * arguments.workers * 2,
+            onStateChange=main.onRenderStateChange,
+            pollInterval=0.1,
+        )
+        context = multiprocessing.get_context("spawn")
+        for _ in range(arguments.nodes):
+            node = context.Process(target=runNode, args=(directory, arguments.workers, renderFunction))
+            node.start()
+            nodes.append(node)
+    else:
+        main.renderPool = RenderPool(
+            arguments.workers,
+            onStateChange=main.onRenderStateChange,
+            renderFunction=renderFunction,
+            maxJobs=arguments.worker_max_jobs,
+            onWorkerReady=main.onWorkerReady,
+        )
+    benchmark.onMessage = main.historyCache.add
+    main.renderPool.start()
+    main.jobStore.start()
+    await main.startPipeline()
+    await main.restoreQueues()
+    lagTask = asyncio.create_task(benchmark.measureLoopLag())
+
+    channels = benchmark.createChannels(serverUrl)
+    # Every render can find as many messages as it asks for
+    for channel in channels:
+        benchmark.addMessages(channel, arguments.messages)
+    admissionTimes = []
+
+    async def request(channel):
+        benchmark.addMessages(channel, arguments.new_messages)
+        interaction = FakeInteraction(benchmark, channel, benchmark.random.choice(channel.users))
+        start = time.perf_counter()
+        benchmark.started[interaction.id] = start
+        messages = arguments.messages
+        if arguments.vary_messages:
+            messages = benchmark.random.randint(1, arguments.messages)
+        await main.render.callback(interaction, messages, main.Music.AceAttorney)
+        admissionTimes.append(time.perf_counter() - start)
+        if benchmark.random.random() < arguments.cancel_ratio:
+            # Users re-running /render with another count, the first one is cancelled
+            await asyncio.sleep(benchmark.random.uniform(0, arguments.render_seconds))
+            for render in list(main.renderQueue):
+                if render.get_id() == interaction.id and main.cancelRender(render):
+                    del benchmark.started[interaction.id]
+                    cancelled.append(interaction.id)
+
+    cancelled = []
+    start = time.perf_counter()
+    requests = []
+    for index in range(arguments.renders):
+        requests.append(asyncio.create_task(request(channels[index % len(channels)])))
+        if arguments.rate > 0:
+            await asyncio.sleep(1 / arguments.rate)
+    await asyncio.gather(*requests)
+
+    deadline = time.perf_counter() + arguments.timeout
+    while len(benchmark.finished) < len(benchmark.started) and time.perf_counter() < deadline:
+        if not main.renderQueue:
+            break
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - start
+    lagTask.cancel()
+
+    # Lets the last deletions go through
+    await asyncio.sleep(float(main.deletionDelay) + 0.5)
+    main.renderPool.stop()
+    for node in nodes:
+        node.terminate()
+        node.join()
+    main.jobStore.stop()
+    await main.evidenceDownloader.close()
+    await main.externalUploader.close()
+    await server.cleanup()
+
+    latencies = [
+        benchmark.finished[interactionId] - started
+        for interactionId, started in benchmark.started.items()
+        if interactionId in benchmark.finished
+    ]
+    return {
+        "renders": arguments.renders,
+        "completed": len(latencies),
+        "cancelled": len(cancelled),
+        # Refused by admission control, or failed
+        "refused": arguments.renders - len(latencies) - len(cancelled),
+        "seconds": round(elapsed, 3),
+        "jobs_per_second": round(len(latencies) / elapsed, 3) if elapsed else 0,
+        "latency_mean": round(statistics.mean(latencies), 3) if latencies else 0,
+        "latency_p50": round(percentile(latencies, 0.5), 3),
+        "latency_p99": round(percentile(latencies, 0.99), 3),
+        "admission_p50": round(percentile(admissionTimes, 0.5), 4),
+        "admission_p99": round(percentile(admissionTimes, 0.99), 4),
+        "loop_lag_p50": round(percentile(benchmark.loopLag, 0.5), 4),
+        "loop_lag_p99": round(percentile(benchmark.loopLag, 0.99), 4),
+        "loop_lag_max": round(max(benchmark.loopLag, default=0), 4),
+        "loop_lag_mean": round(statistics.mean(benchmark.loopLag), 4) if benchmark.loopLag else 0,
+        "api_calls": benchmark.api.calls,
+        # Videos over --size-limit, and the uploads the stand-in dropped
+        "external_uploads": uploads.completed,
+        "upload_drops": uploads.dropped,
+        "messages_deleted": sum(channel.deleted for channel in channels),
+        # Should be 0 once the queue drained, anything else can never be evicted
+        "evidence_references": sum(main.evidenceDownloader.cache.references.values()),
+    }
+
+
+def legacyConvert(update):
+    # Message conversion as it was done before message.convertMessages, kept as a baseline
+    import re
+    from emoji.core import demojize
+
+    try:
+        member = update.guild.get_member(update.author.id)
+        user = (member.display_name, member.id)
+    except Exception:
+        user = (update.author.display_name, update.author.id)
+    text = update.clean_content
+    text = re.sub(r"(https?)\S*", "(link)", text)
+    text = demojize(text)
+    text = re.sub(r"<[a]?(:\w{2,32}:)\d{18,19}>", r"\1", text)
+    text = re.sub(r"\u200b", "", text)
+    for file in update.attachments:
+        if file.filename.split(".")[-1] in {"jpg", "jpeg", "JPG", "JPEG", "png", "PNG"}:
+            text += " (image)"
+        elif file.filename.split(".")[-1] in {"gif", "gifv"}:
+            text += " (gif)"
+        elif file.filename.split(".")[-1] in {"mp4", "webm"}:
+            text += " (video)"
+        elif file.filename.split(".")[-1] in {"mp3", "wav", "ogg"}:
+            text += " (audio)"
+        else:
+            text += " (file)"
+    return user, text
+
+
+def runConversionBenchmark(arguments):
+    # Times converting one page of history, per message as before and with convertMessages
+    from message import convertMessages
+
+    benchmark = Benchmark(arguments)
+    channel = benchmark.createChannels("http://127.0.0.1")[0]
+    results = {}
+    for size in (100, 1000):
+        channel.history_messages = []
+        benchmark.addMessages(channel, size, keep=size)
+        page = list(reversed(channel.history_messages))
+        for name, convert in (
+            ("legacy", lambda: [legacyConvert(update) for update in page]),
+            ("batch", lambda: convertMessages(page)),
+        ):
+            timings = []
+            for _ in range(arguments.repeat):
+                start = time.perf_counter()
+                convert()
+                timings.append(time.perf_counter() - start)
+            results[f"{name}_{size}_ms"] = round(statistics.median(timings) * 1000, 3)
+        results[f"speedup_{size}"] = round(results[f"legacy_{size}_ms"] / results[f"batch_{size}_ms"], 2)
+    return results
+
+
+def writeConfig(arguments):
+    # main.py reads config.yaml from the working directory
+    with open("config.yaml", "w") as file:
+        file.write(
+            f"""token: "benchmark"
+prefix: "/"
+deletionDelay: "{arguments.deletion_delay}"
+max_tasks:
+  per_guild: 100000
+  per_user: 100000
+invite_link: ""
+cooldown: 0
+staff_only: False
+owner_id: 0
+render_workers: {arguments.workers}
+history_cache:
+  size: {arguments.history_cache}
+scheduling:
+  cost_weight: {arguments.cost_weight}
+scratch:
+  quota: {arguments.scratch_quota}
+admission:
+  max_memory: {arguments.queue_memory}
+"""
+        )
+
+
+def parseArguments():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the render pipeline")
+    parser.add_argument("--renders", type=int, default=100, help="number of /render requests")
+    parser.add_argument("--messages", type=int, default=30, help="messages per render")
+    parser.add_argument("--vary-messages", action="store_true", help="pick the messages of each render between 1 and --messages")
+    parser.add_argument("--cost-weight", type=float, default=1.0, help="scheduling.cost_weight, 0 is first come first served")
+    parser.add_argument("--cancel-ratio", type=float, default=0, help="fraction of the renders cancelled after being queued")
+    parser.add_argument("--new-messages", type=int, default=5, help="messages posted in the channel before each request")
+    parser.add_argument("--guilds", type=int, default=5)
+    parser.add_argument("--users-per-guild", type=int, default=10)
+    parser.add_argument("--workers", type=int, default=2, help="render processes, per node with --nodes")
+    parser.add_argument("--worker-max-jobs", type=int, default=0, help="renders before a worker is restarted, 0 for no limit")
+    parser.add_argument("--nodes", type=int, default=0, help="render nodes consuming a spool, 0 renders in the bot")
+    parser.add_argument("--rate", type=float, default=0, help="requests per second, 0 sends them all at once")
+    parser.add_argument("--render", choices=["sleep", "cpu", "real"], default="sleep")
+    parser.add_argument("--render-seconds", type=float, default=0.5, help="fixed cost of a fake render")
+    parser.add_argument("--seconds-per-message", type=float, default=0.02, help="cost per message of a fake render")
+    parser.add_argument("--image-ratio", type=float, default=0.1, help="fraction of messages with an image")
+    parser.add_argument("--image-size", type=int, default=50000, help="bytes per image")
+    parser.add_argument("--video-size", type=int, default=200000, help="bytes per fake video")
+    parser.add_argument("--size-limit", type=int, default=25 * 1024 * 1024, help="bytes the fake servers accept, bigger videos are uploaded externally")
+    parser.add_argument("--upload-drops", type=float, default=0, help="fraction of external uploads dropped by the server")
+    parser.add_argument("--api-latency", type=float, default=0.05, help="seconds per fake Discord call")
+    parser.add_argument("--history-cache", type=int, default=0, help="messages kept by the history cache, 0 disables it")
+    parser.add_argument("--scratch-quota", type=float, default=5000, help="MB of scratch space")
+    parser.add_argument("--queue-memory", type=float, default=0, help="MB the queue can hold before renders are refused, 0 for no limit")
+    parser.add_argument("--deletion-delay", type=int, default=1)
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--conversion", action="store_true", help="only time message conversion, on 100 and 1000 messages")
+    parser.add_argument("--repeat", type=int, default=20, help="runs per conversion timing")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    arguments = parseArguments()
+    repository = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, repository)
+    sys.path.append(os.path.join(repository, "objection_engine"))
+    jsonFilename = os.path.abspath(arguments.json) if arguments.json else None
+    if arguments.conversion:
+        results = runConversionBenchmark(arguments)
+    else:
+        # Caches, job store and videos all go to a throwaway directory
+        with tempfile.TemporaryDirectory() as directory:
+            os.chdir(directory)
+            writeConfig(arguments)
+            results = asyncio.run(runBenchmark(arguments))
+            os.chdir(repository)
+    for name, value in results.items():
+        print(f"{name:>18}: {value}")
+    if jsonFilename:
+        with open(jsonFilename, "w") as file:
+            json.dump(results, file, indent=2)
@@ -0,0 +1,20 @@
+class Comment:
+    """
+    A message of a scene, with the same fields as the engine's Comment. Importing the engine
+    loads the whole rendering stack, so the bot only uses this one; render workers turn them
+    into the engine's own (worker.toEngineComments).
+    """
+
+    __slots__ = ("user_id", "user_name", "text_content", "evidence_path")
+
+    def __init__(
+        self,
+        user_id: str = None,
+        user_name: str = "Prosecutor",
+        text_content: str = "...",
+        evidence_path: str = None,
+    ):
+        self.user_id = user_id
+        self.user_name = user_name
+        self.text_content = text_content
+        self.evidence_path = evidence_path
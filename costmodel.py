@@ -0,0 +1,81 @@
+from collections import deque
+from typing import List
+
+from comment import Comment
+
+
+def solve(matrix: List[List[float]], vector: List[float]):
+    # Gaussian elimination with partial pivoting, the systems here are 5x5
+    size = len(vector)
+    rows = [list(row) + [value] for row, value in zip(matrix, vector)]
+    for column in range(size):
+        pivot = max(range(column, size), key=lambda row: abs(rows[row][column]))
+        rows[column], rows[pivot] = rows[pivot], rows[column]
+        if rows[column][column] == 0:
+            raise ValueError("Singular matrix")
+        for row in range(column + 1, size):
+            factor = rows[row][column] / rows[column][column]
+            for index in range(column, size + 1):
+                rows[row][index] -= factor * rows[column][index]
+    solution = [0.0] * size
+    for row in range(size - 1, -1, -1):
+        total = rows[row][size] - sum(rows[row][index] * solution[index] for index in range(row + 1, size))
+        solution[row] = total / rows[row][row]
+    return solution
+
+
+class CostModel:
+    """
+    Predicts how long a render takes from its message count, text length, evidence count and
+    resolution scale. It's a linear model fitted on the last maxSamples renders that finished;
+    the cost of messages, text and evidence grows with the number of pixels, so they're
+    multiplied by scale². The fit is a ridge regression pulled towards a rough first guess, so
+    estimates are usable before any render finished and follow the measurements afterwards.
+    """
+
+    # Constant, scale², then messages, hundreds of characters and images, all times scale²
+    PRIOR = (5.0, 0.0, 0.6, 0.0, 0.0)
+
+    def __init__(self, maxSamples: int = 500, regularization: float = 10.0):
+        self.samples = deque(maxlen=maxSamples)  # (messages, characters, images, scale, seconds)
+        self.regularization = regularization
+        self.weights = list(self.PRIOR)
+
+    def getFeatures(self, comments: List[Comment], scale: int):
+        return (
+            len(comments),
+            sum(len(comment.text_content) for comment in comments),
+            sum(1 for comment in comments if comment.evidence_path is not None),
+            scale,
+        )
+
+    def getVector(self, messages: int, characters: int, images: int, scale: int):
+        pixels = scale**2
+        return [1.0, pixels, messages * pixels, characters / 100 * pixels, images * pixels]
+
+    def estimate(self, comments: List[Comment], scale: int):
+        vector = self.getVector(*self.getFeatures(comments, scale))
+        return max(1.0, sum(weight * value for weight, value in zip(self.weights, vector)))
+
+    def add(self, messages: int, characters: int, images: int, scale: int, seconds: float):
+        self.samples.append((messages, characters, images, scale, seconds))
+
+    def observe(self, comments: List[Comment], scale: int, seconds: float):
+        self.add(*self.getFeatures(comments, scale), seconds)
+        self.fit()
+
+    def fit(self):
+        # Solves (XᵀX + λI)w = Xᵀy + λ·prior
+        size = len(self.PRIOR)
+        matrix = [[self.regularization if row == column else 0.0 for column in range(size)] for row in range(size)]
+        vector = [self.regularization * weight for weight in self.PRIOR]
+        for *features, seconds in self.samples:
+            values = self.getVector(*features)
+            for row in range(size):
+                vector[row] += values[row] * seconds
+                for column in range(size):
+                    matrix[row][column] += values[row] * values[column]
+        try:
+            self.weights = solve(matrix, vector)
+        except ValueError as exception:
+            print(f"Error: {exception}")
@@ -1,18 +1,103 @@
+import asyncio
+import heapq
+import itertools
+from datetime import datetime, timedelta, timezone
+
 from discord.message import Message
 
+from metrics import DISCORD_API_SECONDS
+
+# Discord refuses to bulk delete messages older than this
+BULK_DELETE_MAX_AGE = timedelta(days=14)
+BULK_DELETE_MAX_COUNT = 100
+
+
 class Deletion:
-    def __init__(self, message: Message, remainingTime: int):
+    def __init__(self, message: Message, deadline: float, sequence: int):
         self.message = message
-        self.remainingTime = remainingTime
-    
-    async def update(self):
-        self.remainingTime = self.remainingTime - 1
-        if (self.remainingTime <= 0):
-            try:
-                await self.message.delete()
-            except Exception as exception:
-                print(f"Error: {exception}")
-            finally:
-                return True
-        else:
-            return False
+        self.deadline = deadline
+        # Keeps deletions with the same deadline in the order they were added
+        self.sequence = sequence
+
+    def __lt__(self, other: "Deletion"):
+        return (self.deadline, self.sequence) < (other.deadline, other.sequence)
+
+
+class DeletionScheduler:
+    """
+    Deletes messages once their delay is over. Pending deletions are kept in a heap ordered by
+    deadline and the scheduler sleeps until the next one is due. Messages due at the same time
+    are grouped by channel and bulk deleted when possible; channels are handled concurrently,
+    up to maxConcurrentChannels at once. onDeleted(message) is called for every message once
+    it has been dealt with.
+    """
+
+    def __init__(self, maxConcurrentChannels: int = 5, onDeleted=None):
+        self.onDeleted = onDeleted
+        self.heap = []
+        self.sequence = itertools.count()
+        self.wakeUp = asyncio.Event()
+        self.channelLimit = asyncio.Semaphore(maxConcurrentChannels)
+
+    def add(self, message: Message, delay: int):
+        deadline = asyncio.get_running_loop().time() + delay
+        deletion = Deletion(message, deadline, next(self.sequence))
+        heapq.heappush(self.heap, deletion)
+        # Only a new earliest deadline changes how long the scheduler has to sleep
+        if self.heap[0] is deletion:
+            self.wakeUp.set()
+
+    def __len__(self):
+        return len(self.heap)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self.wakeUp.clear()
+            if not self.heap:
+                await self.wakeUp.wait()
+                continue
+            delay = self.heap[0].deadline - loop.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self.wakeUp.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            now = loop.time()
+            channels = {}
+            while self.heap and self.heap[0].deadline <= now:
+                message = heapq.heappop(self.heap).message
+                channels.setdefault(message.channel.id, []).append(message)
+            await asyncio.gather(
+                *[self.deleteFromChannel(messages) for messages in channels.values()]
+            )
+
+    async def deleteFromChannel(self, messages: list):
+        async with self.channelLimit:
+            channel = messages[0].channel
+            minimumDate = datetime.now(timezone.utc) - BULK_DELETE_MAX_AGE + timedelta(minutes=1)
+            recent = [message for message in messages if message.created_at > minimumDate]
+            single = [message for message in messages if message.created_at <= minimumDate]
+            if len(recent) > 1 and hasattr(channel, "delete_messages"):
+                for index in range(0, len(recent), BULK_DELETE_MAX_COUNT):
+                    chunk = recent[index : index + BULK_DELETE_MAX_COUNT]
+                    try:
+                        with DISCORD_API_SECONDS.time(call="bulk_delete"):
+                            await channel.delete_messages(chunk)
+                    except Exception as exception:
+                        # Bulk deletes need the Manage Messages permission, delete them one by one instead
+                        print(f"Error: {exception}")
+                        single += chunk
+            else:
+                single += recent
+            for message in single:
+                try:
+                    with DISCORD_API_SECONDS.time(call="delete"):
+                        await message.delete()
+                except Exception as exception:
+                    print(f"Error: {exception}")
+            if self.onDeleted is not None:
+                for message in messages:
+                    self.onDeleted(message)
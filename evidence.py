@@ -0,0 +1,284 @@
+import asyncio
+import hashlib
+import io
+import multiprocessing
+import os
+import warnings
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Iterable, Optional, Tuple
+
+import aiohttp
+from PIL import Image
+
+# Size of a scene at resolution_scale 1, evidence is never drawn bigger than it
+SCENE_SIZE = (256, 192)
+
+
+def writeFile(filename: str, content: bytes):
+    # Written under a temporary name first, so a half written file is never picked up
+    temporaryFilename = f"{filename}.part"
+    with open(temporaryFilename, "wb") as file:
+        file.write(content)
+    os.replace(temporaryFilename, filename)
+
+
+def hashFile(filename: str):
+    digest = hashlib.sha256()
+    with open(filename, "rb") as file:
+        for chunk in iter(lambda: file.read(65536), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def prepareImage(content: bytes, maxSize: Tuple[int, int], maxPixels: int):
+    # Runs in the downloader's process pool. Decodes an image once, shrinks it to maxSize and
+    # returns it as a PNG, whatever it was sent as, or None if it isn't a usable image
+    try:
+        with warnings.catch_warnings():
+            # Pillow only warns about big images, they're rejected below
+            warnings.simplefilter("ignore", Image.DecompressionBombWarning)
+            image = Image.open(io.BytesIO(content))
+        with image:
+            # Only the header is read so far, decompression bombs are rejected before decoding
+            if image.width * image.height > maxPixels:
+                print(f"Error: evidence image is too big ({image.width}x{image.height})")
+                return None
+            # JPEGs can be decoded at a fraction of their size directly
+            image.draft("RGB", maxSize)
+            image = image.convert("RGBA" if "A" in image.getbands() or "transparency" in image.info else "RGB")
+        image.thumbnail(maxSize, Image.LANCZOS)
+        output = io.BytesIO()
+        # Barely compressed, it's decoded for every frame the evidence is shown in
+        image.save(output, format="PNG", compress_level=1)
+        return output.getvalue()
+    except Exception as exception:
+        print(f"Error: {exception}")
+        return None
+
+
+def getEvidenceKey(attachmentId: Optional[int] = None, url: Optional[str] = None):
+    # Attachments are immutable, so their id is enough. Anything else is keyed by its URL
+    if attachmentId is not None:
+        return str(attachmentId)
+    return hashlib.sha256(url.encode("utf-8")).hexdigest()[:32]
+
+
+class EvidenceCache:
+    """
+    Evidence images on disk, named after their key. Files used by a render in flight are
+    reference counted and never evicted; the rest are evicted least recently used first
+    once the cache grows past maxBytes.
+    """
+
+    def __init__(self, directory: str = "evidence_cache", maxBytes: int = 500000000):
+        self.directory = os.path.abspath(directory)
+        self.maxBytes = maxBytes
+        self.entries = OrderedDict()  # key -> size in bytes, least recently used first
+        self.references = {}
+        self.hashes = {}  # key -> sha256 of the file content
+        self.totalBytes = 0
+        os.makedirs(self.directory, exist_ok=True)
+        self.load()
+
+    def load(self):
+        # Files from previous runs are kept, oldest first
+        files = []
+        for filename in os.listdir(self.directory):
+            path = os.path.join(self.directory, filename)
+            if filename.endswith(".part"):
+                os.remove(path)
+                continue
+            if filename.endswith(".png"):
+                stat = os.stat(path)
+                files.append((stat.st_mtime, filename[: -len(".png")], stat.st_size))
+        # Nothing is evicted yet, renders restored after a restart still have to acquire their files
+        for _, key, size in sorted(files):
+            self.entries[key] = size
+            self.totalBytes += size
+
+    def getPath(self, key: str):
+        return os.path.join(self.directory, f"{key}.png")
+
+    def __contains__(self, key: str):
+        return key in self.entries
+
+    def acquire(self, key: str):
+        # Returns the path of the file and keeps it from being evicted until it's released
+        if key not in self.entries:
+            return None
+        self.entries.move_to_end(key)
+        self.references[key] = self.references.get(key, 0) + 1
+        return self.getPath(key)
+
+    def acquirePath(self, path: str):
+        if os.path.dirname(path) != self.directory:
+            return None
+        return self.acquire(os.path.basename(path)[: -len(".png")])
+
+    def release(self, paths: Iterable[str]):
+        for path in paths:
+            if path is None or os.path.dirname(path) != self.directory:
+                continue
+            key = os.path.basename(path)[: -len(".png")]
+            if key in self.references:
+                self.references[key] -= 1
+                if self.references[key] <= 0:
+                    del self.references[key]
+        self.evict()
+
+    async def getContentHash(self, path: str):
+        key = os.path.basename(path)[: -len(".png")]
+        if key not in self.hashes:
+            self.hashes[key] = await asyncio.to_thread(hashFile, path)
+        return self.hashes[key]
+
+    async def add(self, key: str, content: bytes):
+        await asyncio.to_thread(writeFile, self.getPath(key), content)
+        self.hashes[key] = hashlib.sha256(content).hexdigest()
+        if key in self.entries:
+            self.totalBytes -= self.entries[key]
+        self.entries[key] = len(content)
+        self.totalBytes += len(content)
+        self.evict(keep=key)
+
+    def evict(self, keep: Optional[str] = None):
+        for key in list(self.entries):
+            if self.totalBytes <= self.maxBytes:
+                break
+            if key == keep or key in self.references:
+                continue
+            try:
+                os.remove(self.getPath(key))
+            except Exception as exception:
+                print(f"Error: {exception}")
+            self.totalBytes -= self.entries.pop(key)
+            self.hashes.pop(key, None)
+
+
+class EvidenceDownloader:
+    """
+    Downloads the evidence images of a whole render at once, through a connection pool shared
+    by every render. Images bigger than maxSize bytes, or that take longer than timeout seconds,
+    are skipped and the message is rendered without evidence. Images already in the cache
+    aren't downloaded again.
+    Downloaded images are decoded once in a pool of worker processes, shrunk to the scene at
+    maxScale and stored as PNG, so renders never decode a full size photo. Images with more than
+    maxPixels pixels are skipped without being decoded.
+    """
+
+    def __init__(
+        self,
+        cache: EvidenceCache,
+        maxSize: int = 8000000,
+        timeout: int = 10,
+        maxConnections: int = 16,
+        maxScale: int = 2,
+        maxPixels: int = 40000000,
+        workers: int = 1,
+    ):
+        self.cache = cache
+        self.maxSize = maxSize
+        self.imageSize = (SCENE_SIZE[0] * maxScale, SCENE_SIZE[1] * maxScale)
+        self.maxPixels = maxPixels
+        self.workers = max(1, workers)
+        self.executor: Optional[ProcessPoolExecutor] = None
+        self.timeout = timeout
+        self.maxConnections = maxConnections
+        self.session: Optional[aiohttp.ClientSession] = None
+        # Downloads in flight, so two renders sharing an image only fetch it once
+        self.pending = {}
+        # key -> messages waiting for its download in flight, store() gives them their reference
+        self.waiting = {}
+
+    def getSession(self):
+        # Created lazily, the session has to be created inside the bot's event loop
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.maxConnections),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self.session
+
+    def getExecutor(self):
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(
+                self.workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        return self.executor
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    async def prepare(self, content: bytes):
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(
+                self.getExecutor(), prepareImage, content, self.imageSize, self.maxPixels
+            )
+        except BrokenProcessPool:
+            # A worker died decoding an image, the next one gets a new pool
+            print("Error: an evidence image worker died, restarting the pool")
+            self.executor = None
+            return None
+
+    async def download(self, messages: list):
+        pending = [message for message in messages if message.evidenceUrl is not None]
+        await asyncio.gather(*[self.downloadEvidence(message) for message in pending])
+
+    async def downloadEvidence(self, message):
+        key = message.evidenceKey
+        if key in self.cache:
+            message.evidence = self.cache.acquire(key)
+            return
+        task = self.pending.get(key)
+        if task is None:
+            task = asyncio.create_task(self.store(key, message.evidenceUrl))
+            self.pending[key] = task
+            task.add_done_callback(lambda _: self.pending.pop(key, None))
+        waiting = self.waiting.setdefault(key, [])
+        waiting.append(message)
+        try:
+            await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if self.waiting.get(key) is waiting and message in waiting:
+                waiting.remove(message)
+            elif message.evidence is not None:
+                # Its reference was taken right before the render was cancelled
+                self.cache.release([message.evidence])
+                message.evidence = None
+            raise
+
+    async def store(self, key: str, url: str):
+        try:
+            content = await self.fetch(url)
+            if content is not None:
+                content = await self.prepare(content)
+            if content is not None:
+                await self.cache.add(key, content)
+        except Exception as exception:
+            print(f"Error: {exception}")
+        finally:
+            # Taken right away: once this returns, another image stored before the renders waiting
+            # for this one resume could evict it
+            for message in self.waiting.pop(key, []):
+                message.evidence = self.cache.acquire(key)
+
+    async def fetch(self, url: str):
+        async with self.getSession().get(url) as response:
+            response.raise_for_status()
+            if response.content_length is not None and response.content_length > self.maxSize:
+                print(f"Error: {url} is too big ({response.content_length} bytes)")
+                return None
+            content = bytearray()
+            async for chunk in response.content.iter_chunked(65536):
+                content += chunk
+                # Content-Length can be missing or wrong, so the limit is also checked while reading
+                if len(content) > self.maxSize:
+                    print(f"Error: {url} is bigger than {self.maxSize} bytes")
+                    return None
+            return bytes(content)
@@ -0,0 +1,100 @@
+import asyncio
+import textwrap
+import weakref
+from collections import OrderedDict
+
+from metrics import DISCORD_API_SECONDS
+from render import Render
+
+
+class FeedbackUpdater:
+    """
+    Edits feedback messages in the background, so state changes never wait for Discord.
+    Only the newest content of each message is kept while it waits to be sent. Every channel
+    gets its own sender that edits at most once every channelInterval seconds, to stay inside
+    the channel's rate limit, and channels are served concurrently up to maxConcurrentEdits.
+    Position-only updates come after any other update, and once more than heavyLoad edits are
+    waiting they are only sent once every positionInterval seconds per message.
+    """
+
+    def __init__(
+        self,
+        channelInterval: float = 1.0,
+        maxConcurrentEdits: int = 10,
+        heavyLoad: int = 20,
+        positionInterval: float = 15.0,
+    ):
+        self.channelInterval = channelInterval
+        self.heavyLoad = heavyLoad
+        self.positionInterval = positionInterval
+        self.editLimit = asyncio.Semaphore(maxConcurrentEdits)
+        self.channels = {}  # channel id -> OrderedDict of render -> (content, positionOnly)
+        self.senders = {}  # channel id -> task sending that channel's edits
+        # channel id -> event set when a state change is queued, wakes up a sender waiting
+        # for its throttled position updates
+        self.stateChanges = {}
+        self.lastEdit = weakref.WeakKeyDictionary()  # render -> loop time of its last edit
+
+    def update(self, render: Render, content: str, positionOnly: bool = False):
+        content = textwrap.dedent(content).strip("\n")
+        channelId = render.getChannel().id
+        pending = self.channels.setdefault(channelId, OrderedDict())
+        pending[render] = (content, positionOnly)
+        if not positionOnly and channelId in self.stateChanges:
+            self.stateChanges[channelId].set()
+        if channelId not in self.senders:
+            self.senders[channelId] = asyncio.create_task(self.sendChannel(channelId))
+
+    def forget(self, render: Render):
+        # Drops the queue position updates of a finished render, the edits telling how it ended are kept
+        pending = self.channels.get(render.getChannel().id)
+        if pending is not None and render in pending and pending[render][1]:
+            del pending[render]
+
+    def getPendingCount(self):
+        return sum(len(pending) for pending in self.channels.values())
+
+    def pick(self, pending: OrderedDict, now: float):
+        # Returns the next render to edit, or how long to wait if only throttled updates are left
+        for render, (_, positionOnly) in pending.items():
+            if not positionOnly:
+                return render, 0
+        if self.getPendingCount() <= self.heavyLoad:
+            return next(iter(pending)), 0
+        wait = self.positionInterval
+        for render in pending:
+            elapsed = now - self.lastEdit.get(render, 0)
+            if elapsed >= self.positionInterval:
+                return render, 0
+            wait = min(wait, self.positionInterval - elapsed)
+        return None, wait
+
+    async def sendChannel(self, channelId: int):
+        loop = asyncio.get_running_loop()
+        pending = self.channels[channelId]
+        stateChange = self.stateChanges[channelId] = asyncio.Event()
+        try:
+            while pending:
+                render, wait = self.pick(pending, loop.time())
+                if render is None:
+                    # Only throttled position updates are left, a state change doesn't wait for them
+                    stateChange.clear()
+                    try:
+                        await asyncio.wait_for(stateChange.wait(), wait)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                content, _ = pending.pop(render)
+                async with self.editLimit:
+                    try:
+                        with DISCORD_API_SECONDS.time(call="feedback_edit"):
+                            await render.updateFeedback(content)
+                    except Exception as exception:
+                        print(f"Error: {exception}")
+                self.lastEdit[render] = loop.time()
+                await asyncio.sleep(self.channelInterval)
+        finally:
+            del self.senders[channelId]
+            del self.stateChanges[channelId]
+            if not pending:
+                del self.channels[channelId]
@@ -0,0 +1,40 @@
+from typing import List
+
+from comment import Comment
+from costmodel import CostModel
+
+
+class QualityGovernor:
+    """
+    Picks the resolution scale of each render when it's handed to a worker. Renders get the
+    highest scale whose expected end-to-end time (waiting for the renders ahead plus rendering
+    itself) stays within targetLatency seconds, and the lowest scale when nothing fits.
+    Render times come from costModel, which learns them from the renders that finish.
+    """
+
+    def __init__(
+        self,
+        costModel: CostModel,
+        targetLatency: float = 180,
+        minScale: int = 1,
+        maxScale: int = 2,
+    ):
+        self.costModel = costModel
+        self.targetLatency = targetLatency
+        self.minScale = minScale
+        self.maxScale = maxScale
+
+    def choose(self, comments: List[Comment], backlog: int, wait: float):
+        # Returns the scale and the reason it was picked, backlog is how many renders are still
+        # waiting and wait the seconds until they're expected to leave a worker free
+        if backlog == 0:
+            return self.maxScale, "queue is idle"
+        for scale in range(self.maxScale, self.minScale - 1, -1):
+            expected = wait + self.costModel.estimate(comments, scale)
+            if expected <= self.targetLatency:
+                return scale, f"expected {round(expected)}s with {backlog} render(s) waiting"
+        expected = wait + self.costModel.estimate(comments, self.minScale)
+        return (
+            self.minScale,
+            f"queue saturated, expected {round(expected)}s with {backlog} render(s) waiting",
+        )
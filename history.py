@@ -0,0 +1,118 @@
+import copy
+from collections import OrderedDict
+from typing import List
+
+import discord
+
+import metrics
+from message import Message, convertMessages
+
+
+class HistoryCache:
+    """
+    The latest messages of every channel the bot sees messages in, converted as they arrive
+    from the gateway, so renders don't have to ask Discord for the channel's history.
+    A channel's buffer holds every message since the first one the bot saw there, up to
+    channelSize of them; older messages are fetched from the API when a render needs them and
+    kept too. At most maxMessages are kept in total, the channels idle the longest are dropped
+    first. With maxMessages set to 0 everything is fetched from the API.
+    """
+
+    def __init__(self, maxMessages: int = 0, channelSize: int = 200):
+        self.maxMessages = maxMessages
+        self.channelSize = channelSize
+        self.channels = OrderedDict()  # channel id -> message id -> Message, oldest first
+        self.size = 0
+
+    def add(self, update: discord.Message):
+        if self.maxMessages <= 0:
+            return
+        buffer = self.channels.get(update.channel.id)
+        if buffer is None:
+            buffer = self.channels[update.channel.id] = OrderedDict()
+        self.channels.move_to_end(update.channel.id)
+        if update.id not in buffer:
+            self.size += 1
+        buffer[update.id] = convertMessages([update])[0]
+        if len(buffer) > self.channelSize:
+            buffer.popitem(last=False)
+            self.size -= 1
+        self.evict()
+
+    def edit(self, update: discord.Message):
+        buffer = self.channels.get(update.channel.id)
+        if buffer is not None and update.id in buffer:
+            buffer[update.id] = convertMessages([update])[0]
+
+    def delete(self, channelId: int, messageIds):
+        buffer = self.channels.get(channelId)
+        if buffer is None:
+            return
+        for messageId in messageIds:
+            if buffer.pop(messageId, None) is not None:
+                self.size -= 1
+
+    def clear(self):
+        # Messages sent while the bot was disconnected are missing, buffers can't be trusted anymore
+        self.channels.clear()
+        self.size = 0
+
+    def evict(self):
+        while self.size > self.maxMessages and self.channels:
+            _, buffer = self.channels.popitem(last=False)
+            self.size -= len(buffer)
+
+    async def getMessage(self, channel, messageId: int):
+        buffer = self.channels.get(channel.id)
+        if buffer is not None and messageId in buffer:
+            metrics.HISTORY_CACHE_LOOKUPS_TOTAL.inc(outcome="hit")
+            return copy.copy(buffer[messageId])
+        with metrics.DISCORD_API_SECONDS.time(call="fetch_message"):
+            update = await channel.fetch_message(messageId)
+        return convertMessages([update])[0]
+
+    async def getHistory(self, channel, limit: int, before: int, command: str) -> List[Message]:
+        # Returns up to limit converted messages sent before the message with id before, newest
+        # first, like channel.history
+        buffer = self.channels.get(channel.id)
+        messages = []
+        if buffer is not None:
+            for message in reversed(buffer.values()):
+                if len(messages) == limit:
+                    break
+                if message.id < before:
+                    messages.append(copy.copy(message))
+        if len(messages) == limit:
+            metrics.HISTORY_CACHE_LOOKUPS_TOTAL.inc(outcome="hit")
+            return messages
+
+        metrics.HISTORY_CACHE_LOOKUPS_TOTAL.inc(outcome="partial" if messages else "miss")
+        # Only the part the buffer doesn't cover is fetched
+        start = messages[-1].id if messages else before
+        with metrics.DISCORD_API_SECONDS.time(call="history"):
+            updates = [
+                update
+                async for update in channel.history(
+                    limit=limit - len(messages), before=discord.Object(id=start)
+                )
+            ]
+        with metrics.MESSAGE_CONVERSION_SECONDS.time(command=command):
+            fetched = convertMessages(updates)
+        if messages and self.channels.get(channel.id) is buffer:
+            # These come right before the oldest buffered message, the buffer stays gapless
+            self.prepend(channel.id, buffer, fetched)
+            fetched = [copy.copy(message) for message in fetched]
+        return messages + fetched
+
+    def prepend(self, channelId: int, buffer: OrderedDict, fetched: List[Message]):
+        room = self.channelSize - len(buffer)
+        if room <= 0:
+            return
+        older = [message for message in reversed(fetched[:room]) if message.id not in buffer]
+        merged = OrderedDict((message.id, message) for message in older)
+        merged.update(buffer)
+        buffer.clear()
+        buffer.update(merged)
+        self.size += len(older)
+        self.channels.move_to_end(channelId)
+        self.evict()
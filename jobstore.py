@@ -0,0 +1,245 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from comment import Comment
+from render import Render, State
+
+# Render durations kept for costmodel.CostModel
+RENDER_TIMES_KEPT = 2000
+
+
+class JobStore:
+    """
+    Keeps the render queue, the pending deletions and the render durations in SQLite, so they
+    survive a restart.
+    Changes are only recorded in memory by the bot and written by a background thread every
+    flushInterval seconds, in a single transaction. Several changes to the same render in
+    between are merged into one write.
+    """
+
+    def __init__(self, filename: str = "jobs.sqlite3", flushInterval: float = 0.5):
+        self.flushInterval = flushInterval
+        # No job store yet: this is the first start, or the previous run was a version without one
+        self.created = not os.path.exists(filename)
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS renders (
+                id INTEGER PRIMARY KEY,
+                state INTEGER NOT NULL,
+                guild_id INTEGER NOT NULL,
+                channel_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                feedback_message_id INTEGER,
+                music_code TEXT NOT NULL,
+                messages TEXT NOT NULL,
+                output_filename TEXT NOT NULL,
+                cache_key TEXT,
+                created_at REAL NOT NULL
+            )
+            """
+        )
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS deletions (
+                channel_id INTEGER NOT NULL,
+                message_id INTEGER NOT NULL,
+                deadline REAL NOT NULL,
+                PRIMARY KEY (channel_id, message_id)
+            )
+            """
+        )
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS render_times (
+                messages INTEGER NOT NULL,
+                characters INTEGER NOT NULL,
+                images INTEGER NOT NULL,
+                scale INTEGER NOT NULL,
+                seconds REAL NOT NULL
+            )
+            """
+        )
+        self.connection.commit()
+        self.lock = threading.Lock()
+        # The connection is shared by the writer thread and the bot, when loading at startup
+        self.connectionLock = threading.Lock()
+        self.written = set()  # ids of the renders already inserted
+        self.pendingRenders = {}  # id -> render to insert or update, None to delete it
+        self.pendingDeletions = {}  # (channel id, message id) -> deadline, None to delete it
+        self.pendingRenderTimes = []  # (messages, characters, images, scale, seconds)
+        self.wakeUp = threading.Event()
+        self.running = False
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="JobStore", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.wakeUp.set()
+        self.thread.join()
+        self.flush()
+        self.connection.close()
+
+    def saveRender(self, render: Render):
+        with self.lock:
+            self.pendingRenders[render.get_id()] = render
+
+    def removeRender(self, jobId: int):
+        with self.lock:
+            self.pendingRenders[jobId] = None
+
+    def addDeletion(self, channelId: int, messageId: int, deadline: float):
+        with self.lock:
+            self.pendingDeletions[(channelId, messageId)] = deadline
+
+    def removeDeletion(self, channelId: int, messageId: int):
+        with self.lock:
+            self.pendingDeletions[(channelId, messageId)] = None
+
+    def addRenderTime(self, messages: int, characters: int, images: int, scale: int, seconds: float):
+        with self.lock:
+            self.pendingRenderTimes.append((messages, characters, images, scale, seconds))
+
+    def run(self):
+        while self.running:
+            self.wakeUp.wait(self.flushInterval)
+            try:
+                self.flush()
+            except Exception as exception:
+                print(f"Error: {exception}")
+
+    def flush(self):
+        with self.lock:
+            renders = self.pendingRenders
+            deletions = self.pendingDeletions
+            renderTimes = self.pendingRenderTimes
+            self.pendingRenders = {}
+            self.pendingDeletions = {}
+            self.pendingRenderTimes = []
+        if not renders and not deletions and not renderTimes:
+            return
+        with self.connectionLock, self.connection:
+            for jobId, render in renders.items():
+                if render is None:
+                    self.connection.execute("DELETE FROM renders WHERE id = ?", (jobId,))
+                    self.written.discard(jobId)
+                elif jobId in self.written:
+                    self.connection.execute(
+                        "UPDATE renders SET state = ?, feedback_message_id = ?, output_filename = ? WHERE id = ?",
+                        (
+                            render.getState().value,
+                            self.getMessageId(render.getFeedbackMessage()),
+                            render.getOutputFilename(),
+                            jobId,
+                        ),
+                    )
+                else:
+                    self.connection.execute(
+                        "INSERT OR REPLACE INTO renders VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        (
+                            jobId,
+                            render.getState().value,
+                            render.get_guild_id(),
+                            render.getChannel().id,
+                            render.get_user_id(),
+                            self.getMessageId(render.getFeedbackMessage()),
+                            render.music_code,
+                            json.dumps(
+                                [
+                                    [
+                                        comment.user_id,
+                                        comment.user_name,
+                                        comment.text_content,
+                                        comment.evidence_path,
+                                    ]
+                                    for comment in render.getMessages()
+                                ]
+                            ),
+                            render.getOutputFilename(),
+                            render.cacheKey,
+                            time.time(),
+                        ),
+                    )
+                    self.written.add(jobId)
+            for (channelId, messageId), deadline in deletions.items():
+                if deadline is None:
+                    self.connection.execute(
+                        "DELETE FROM deletions WHERE channel_id = ? AND message_id = ?",
+                        (channelId, messageId),
+                    )
+                else:
+                    self.connection.execute(
+                        "INSERT OR REPLACE INTO deletions VALUES (?, ?, ?)",
+                        (channelId, messageId, deadline),
+                    )
+            if renderTimes:
+                self.connection.executemany(
+                    "INSERT INTO render_times VALUES (?, ?, ?, ?, ?)", renderTimes
+                )
+                # Only the recent ones are used, see loadRenderTimes
+                self.connection.execute(
+                    "DELETE FROM render_times WHERE rowid <= (SELECT MAX(rowid) FROM render_times) - ?",
+                    (RENDER_TIMES_KEPT,),
+                )
+
+    def getMessageId(self, message):
+        if message is None:
+            return None
+        return message.id
+
+    def loadRenders(self):
+        # Returns the stored renders oldest first, as dictionaries
+        with self.connectionLock:
+            rows = self.connection.execute(
+                "SELECT id, state, guild_id, channel_id, user_id, feedback_message_id, music_code, messages, output_filename, cache_key FROM renders ORDER BY created_at"
+            ).fetchall()
+        renders = []
+        for row in rows:
+            renders.append(
+                {
+                    "id": row[0],
+                    "state": State(row[1]),
+                    "guild_id": row[2],
+                    "channel_id": row[3],
+                    "user_id": row[4],
+                    "feedback_message_id": row[5],
+                    "music_code": row[6],
+                    "messages": [
+                        Comment(
+                            user_id=userId,
+                            user_name=userName,
+                            text_content=textContent,
+                            evidence_path=evidencePath,
+                        )
+                        for userId, userName, textContent, evidencePath in json.loads(row[7])
+                    ],
+                    "output_filename": row[8],
+                    "cache_key": row[9],
+                }
+            )
+            self.written.add(row[0])
+        return renders
+
+    def loadRenderTimes(self, limit: int = 500):
+        # Returns the last render durations, oldest first, as (messages, characters, images, scale, seconds)
+        with self.connectionLock:
+            rows = self.connection.execute(
+                "SELECT messages, characters, images, scale, seconds FROM render_times ORDER BY rowid DESC LIMIT ?",
+                (limit,),
+            ).fetchall()
+        return rows[::-1]
+
+    def loadDeletions(self):
+        # Returns (channel id, message id, deadline) for every pending deletion
+        with self.connectionLock:
+            return self.connection.execute(
+                "SELECT channel_id, message_id, deadline FROM deletions ORDER BY deadline"
+            ).fetchall()
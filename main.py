@@ -1,58 +1,54 @@
+import asyncio
 import traceback
 import re
 import discord
 import os
 import random
-import requests
 import sys
-import threading
 import time
 import json
 import yaml
-import gc
+import heapq
+from collections import Counter
+import metrics
+import multiprocessing
 
 from discord import app_commands, Interaction
 
 sys.path.append("./objection_engine")
 
-from deletion import Deletion
-from discord.ext import commands, tasks
+from admission import AdmissionController
+from costmodel import CostModel
+from deletion import DeletionScheduler
+from feedback import FeedbackUpdater
+from governor import QualityGovernor
+from history import HistoryCache
+from evidence import EvidenceCache, EvidenceDownloader
+from jobstore import JobStore
 from message import Message
-from objection_engine.beans.comment import Comment
-from objection_engine.renderer import render_comment_list
-from objection_engine import get_all_music_available
+from rendercache import RenderCache, linkFile
+from comment import Comment
 from render import Render, State
-from typing import List
+from scheduler import RenderScheduler
+from scratch import ScratchSpace
+from spool import SpoolPool
+from uploader import createExternalUploader, retry
+from typing import List, Optional
 from enum import Enum
+from worker import RenderPool, loadMusicList
 
 # Global Variables:
 renderQueue = []
-deletionQueue = []
+feedbackUpdater = FeedbackUpdater()
 lastRender = 0
-music_arr = get_all_music_available()
-music_dict = {
-    "tat": "TrialsAndTribulations",
-    "jfa": "JusticeForAll",
-    "pwr": "AceAttorney",
-    "rnd": "Random",
-}
-
-
-def get_music_name(song: str):
-    if song in music_arr:
-        return music_dict[song]
-    else:
-        return song
-
-
-def create_music_enum():
-    music_list = []
-    for m in music_arr:
-        music_list.append((get_music_name(m), m))
-    return Enum("Music", music_list)
-
-
-Music = create_music_enum()
+# Reacting with it on a feedback message cancels the render
+CANCEL_EMOJI = "❌"
+# Set up in setup_hook, once the bot's event loop is running
+eventLoop = None
+uploadQueue = None
+queueChanged = None
+# Set once the renders left by the previous run were restored
+restored = False
 
 intents = discord.Intents.default()
 intents.members = True
@@ -62,7 +58,7 @@ def loadConfig():
     try:
         with open("config.yaml") as file:
             config = yaml.load(file, Loader=yaml.FullLoader)
-            global token, prefix, deletionDelay, max_per_guild, max_per_user, invite_link, cooldown, staff_only, owner_id
+            global token, prefix, deletionDelay, max_per_guild, max_per_user, invite_link, cooldown, staff_only, owner_id, render_workers, qualityGovernor, evidenceDownloader, renderCache, upload_concurrency, upload_retries, externalUploader, transcode_codec, jobStore, metrics_config, historyCache, spool_config, renderScheduler, costModel, scratchSpace, scratch_wait, memory_config, admissionController, assets_config
 
             token = config["token"].strip()
             if not token:
@@ -104,6 +100,97 @@ def loadConfig():
                     "The 'owner_id' field is missing in the config file (config.yaml)!"
                 )
 
+            render_workers = config.get("render_workers")
+            if not render_workers:
+                render_workers = 1
+
+            # Queued renders and pending deletions are kept here, to be resumed after a restart
+            jobStore = JobStore(config.get("job_store") or "jobs.sqlite3")
+
+            # Learns how long renders take from the ones that finished, including before a restart
+            costModel = CostModel()
+            for renderTime in jobStore.loadRenderTimes():
+                costModel.add(*renderTime)
+            costModel.fit()
+
+            quality = config.get("quality") or {}
+            qualityGovernor = QualityGovernor(
+                costModel,
+                targetLatency=quality.get("target_latency") or 180,
+                minScale=quality.get("min_scale") or 1,
+                maxScale=quality.get("max_scale") or 2,
+            )
+
+            # Render workers restart once they rendered or grew too much, see worker.RenderPool
+            memory_config = config.get("memory") or {}
+            # Render workers share the engine's decoded images and sounds, see assets.AssetStore
+            assets_config = config.get("assets") or {}
+
+            scheduling = config.get("scheduling") or {}
+            cost_weight = scheduling.get("cost_weight")
+            renderScheduler = RenderScheduler(costWeight=1.0 if cost_weight is None else cost_weight)
+
+            evidence = config.get("evidence") or {}
+            evidenceDownloader = EvidenceDownloader(
+                EvidenceCache(
+                    directory=evidence.get("cache_dir") or "evidence_cache",
+                    maxBytes=int((evidence.get("cache_size") or 500) * 1000000),
+                ),
+                maxSize=int((evidence.get("max_size") or 8) * 1000000),
+                timeout=evidence.get("timeout") or 10,
+                maxScale=qualityGovernor.maxScale,
+                maxPixels=int((evidence.get("max_pixels") or 40) * 1000000),
+                workers=evidence.get("workers") or 1,
+            )
+
+            scratch = config.get("scratch") or {}
+            scratchSpace = ScratchSpace(
+                directory=scratch.get("dir") or "scratch",
+                quota=int((scratch.get("quota") or 5000) * 1000000),
+            )
+            # Seconds a new render waits for disk space before it's refused
+            scratch_wait = scratch.get("wait")
+            if scratch_wait is None:
+                scratch_wait = 60
+
+            # New renders are refused once the queue holds this much, see admission.AdmissionController
+            admission = config.get("admission") or {}
+            admissionController = AdmissionController(
+                maxMemory=int((admission.get("max_memory") or 0) * 1000000),
+                maxDisk=int((admission.get("max_disk") or 0) * 1000000),
+            )
+
+            cache = config.get("render_cache") or {}
+            renderCache = RenderCache(
+                directory=cache.get("dir") or "render_cache",
+                maxBytes=int((cache.get("size") or 2000) * 1000000),
+            )
+
+            uploads = config.get("uploads") or {}
+            upload_concurrency = uploads.get("concurrency") or 3
+            upload_retries = uploads.get("retries") or 3
+            externalUploader = createExternalUploader(
+                name=uploads.get("external") or "uguu",
+                url=uploads.get("external_url"),
+            )
+
+            # Codec used to re-encode videos too big for their server, h264 (mp4) or vp9 (webm)
+            transcode_codec = (config.get("transcode") or {}).get("codec") or "h264"
+
+            metrics_config = config.get("metrics") or {}
+
+            # Renders are written to this directory for render nodes (spool.py) instead of rendered here
+            spool_config = config.get("spool") or {}
+
+            history = config.get("history_cache") or {}
+            historyCache = HistoryCache(
+                maxMessages=history.get("size") or 0,
+                channelSize=history.get("channel_size") or 200,
+            )
+            if historyCache.maxMessages > 0:
+                # Without this privileged intent, messages that don't mention the bot arrive empty
+                intents.message_content = True
+
             return True
     except KeyError as keyErrorException:
         print(
@@ -114,8 +201,32 @@ def loadConfig():
         return False
 
 
-if not loadConfig():
-    exit()
+# Cached on disk, the bot process never imports the render engine. Render and evidence workers
+# re-import this file, they only read what the bot cached before starting them
+music_arr = loadMusicList(listMissing=multiprocessing.parent_process() is None)
+music_dict = {
+    "tat": "TrialsAndTribulations",
+    "jfa": "JusticeForAll",
+    "pwr": "AceAttorney",
+    "rnd": "Random",
+}
+
+
+def get_music_name(song: str):
+    if song in music_arr:
+        return music_dict[song]
+    else:
+        return song
+
+
+def create_music_enum():
+    music_list = []
+    for m in music_arr:
+        music_list.append((get_music_name(m), m))
+    return Enum("Music", music_list)
+
+
+Music = create_music_enum()
 
 courtBot = discord.Client(intents=intents)
 currentActivityText = f"/help"
@@ -136,11 +247,21 @@ async def changeActivity(newActivityText):
         print(f"Error: {exception}")
 
 
-def addToDeletionQueue(message: discord.Message):
-    # Only if deletion delay is grater than 0, add it to the deletionQueue.
-    if int(deletionDelay) > 0:
-        newDeletion = Deletion(message, int(deletionDelay))
-        deletionQueue.append(newDeletion)
+def addToDeletionQueue(message: Optional[discord.Message]):
+    # Only if deletion delay is grater than 0, add it to the deletion scheduler.
+    # Restored renders whose feedback message is gone have none to delete
+    if message is not None and int(deletionDelay) > 0:
+        deletionScheduler.add(message, int(deletionDelay))
+        jobStore.addDeletion(
+            message.channel.id, message.id, time.time() + int(deletionDelay)
+        )
+
+
+def forgetDeletion(message: discord.Message):
+    jobStore.removeDeletion(message.channel.id, message.id)
+
+
+deletionScheduler = DeletionScheduler(onDeleted=forgetDeletion)
 
 
 @tree.command(
@@ -229,6 +350,11 @@ async def help(interaction: Interaction):
     helpEmbed.add_field(
         name="Know available music", value=f"`{prefix}music`", inline=False
     )
+    helpEmbed.add_field(
+        name="Cancel a render",
+        value=f"`{prefix}cancel`, or react with {CANCEL_EMOJI} to its message",
+        inline=False,
+    )
     helpEmbed.add_field(
         name="Starting message",
         value="The bot will start from the last message sent, excluding the slash command you sent. If you want it to "
@@ -239,6 +365,33 @@ async def help(interaction: Interaction):
     await interaction.followup.send(embed=helpEmbed)
 
 
+@tree.command(
+    name="cancel",
+    description="Cancel your last render in this server, unless it's already being uploaded",
+)
+async def cancel(interaction: Interaction):
+    await interaction.response.defer()
+    render = next(
+        (
+            render
+            for render in reversed(renderQueue)
+            if render.get_user_id() == interaction.user.id
+            and render.get_guild_id() == interaction.guild_id
+            and render.getState() in (State.QUEUED, State.INPROGRESS)
+            and not render.cancelled
+        ),
+        None,
+    )
+    if render is not None and cancelRender(render):
+        message = await interaction.followup.send("Your render was cancelled.")
+    else:
+        errEmbed = discord.Embed(
+            description="You have no render that can be cancelled!", color=0xFF0000
+        )
+        message = await interaction.followup.send(embed=errEmbed)
+    addToDeletionQueue(message)
+
+
 # This command is only for the bot owner, it will ignore everybody else
 @tree.command(
     name="queue",
@@ -260,6 +413,7 @@ async def queue(interaction: Interaction):
         global renderQueue
         renderQueueSize = len(renderQueue)
         queue.write(f"There are {renderQueueSize} item(s) in the queue!\n")
+        queue.write(f"Render cache: {renderCache.getStats()}\n")
         for positionInQueue, render in enumerate(iterable=renderQueue):
             queue.write(f"\n#{positionInQueue:04}\n")
             try:
@@ -286,6 +440,13 @@ async def queue(interaction: Interaction):
                 queue.write(f"State: {render.getStateString()}\n")
             except:
                 pass
+            try:
+                if render.scaleReason is not None:
+                    queue.write(
+                        f"Resolution scale: {render.resolutionScale} ({render.scaleReason})\n"
+                    )
+            except:
+                pass
     await interaction.followup.send(file=discord.File(filename))
     clean([], filename)
 
@@ -324,37 +485,33 @@ async def render(
 
     global renderQueue
     feedbackMessage = await interaction.followup.send(content="`Checking queue...`")
-    petitionsFromSameGuild = [
-        x for x in renderQueue if x.get_guild_id() == interaction.guild_id
-    ]
-    petitionsFromSameUser = [
-        x for x in renderQueue if x.get_user_id() == interaction.user.id
-    ]
+    messages = []
+    newRender = None
+    petitionsFromSameGuild = renderScheduler.getGuildCount(interaction.guild_id)
+    petitionsFromSameUser = renderScheduler.getUserCount(interaction.user.id)
     try:
-        if len(petitionsFromSameGuild) > max_per_guild:
+        if petitionsFromSameGuild > max_per_guild:
             raise Exception(f"Only up to {max_per_guild} renders per guild are allowed")
-        if len(petitionsFromSameUser) > max_per_user:
+        if petitionsFromSameUser > max_per_user:
             raise Exception(f"Only up to {max_per_user} renders per user are allowed")
         await feedbackMessage.edit(content="`Fetching messages...`")
         if num_messages == 0:
             raise Exception("Please specify the number of messages to be rendered!")
         if not (num_messages in range(1, 101)):
             raise Exception("Number of messages must be between 1 and 100")
-
-        courtMessages = []
+        # Checked again with the real messages once they're fetched
+        checkAdmission(admissionController.estimate(num_messages))
 
         # No need to remove calling message since slash commands don't have that
-        discordMessages = [
-            message
-            async for message in interaction.channel.history(
-                limit=num_messages, oldest_first=False, before=interaction.created_at
+        with metrics.HISTORY_FETCH_SECONDS.time(command="slash"):
+            messages = await historyCache.getHistory(
+                interaction.channel, num_messages, before=interaction.id, command="slash"
             )
-        ]
-
-        for discordMessage in discordMessages:
-            message = Message(discordMessage)
-            if message.text.strip():
-                courtMessages.insert(0, message.to_Comment())
+        messages = [message for message in messages if message.text.strip()]
+        with metrics.EVIDENCE_DOWNLOAD_SECONDS.time():
+            await evidenceDownloader.download(messages)
+        # History is newest first, scenes go oldest first
+        courtMessages = [message.to_Comment() for message in reversed(messages)]
 
         if len(courtMessages) < 1:
             raise Exception("There should be at least one person in the conversation.")
@@ -366,13 +523,21 @@ async def render(
             music=music.value,
             discordInteraction=interaction,
         )
-        renderQueue.append(newRender)
+        newRender.cacheKey = await renderCache.getKey(
+            courtMessages, newRender.music_code, evidenceDownloader.cache
+        )
+        await enqueueRender(newRender)
+        metrics.ADMISSIONS_TOTAL.inc(result="accepted")
 
         lastRender = time.time()
 
     except Exception as exception:
+        metrics.ADMISSIONS_TOTAL.inc(result="refused")
         traceback.print_exc()
         print(exception)
+        if newRender not in renderQueue:
+            # It was never queued, nothing else will release the evidence it holds
+            evidenceDownloader.cache.release([message.evidence for message in messages])
         exceptionEmbed = discord.Embed(description=str(exception), color=0xFF0000)
         await feedbackMessage.edit(content="", embed=exceptionEmbed)
         addToDeletionQueue(feedbackMessage)
@@ -380,6 +545,7 @@ async def render(
 
 @courtBot.event
 async def on_message(message):
+    historyCache.add(message)
     if courtBot.user in message.mentions:
         matches = re.findall(
             "<@" + rf"{courtBot.user.id}" + "> render ([0-9]+) ?([a-zA-Z]{3})?", message.content
@@ -405,6 +571,34 @@ async def on_message(message):
             return
 
 
+@courtBot.event
+async def on_raw_reaction_add(payload: discord.RawReactionActionEvent):
+    if str(payload.emoji) != CANCEL_EMOJI or payload.user_id == courtBot.user.id:
+        return
+    for render in list(renderQueue):
+        feedbackMessage = render.getFeedbackMessage()
+        if feedbackMessage is not None and feedbackMessage.id == payload.message_id:
+            # Only the user who asked for the render can cancel it
+            if render.get_user_id() == payload.user_id:
+                cancelRender(render)
+            return
+
+
+@courtBot.event
+async def on_raw_message_edit(payload: discord.RawMessageUpdateEvent):
+    historyCache.edit(payload.message)
+
+
+@courtBot.event
+async def on_raw_message_delete(payload: discord.RawMessageDeleteEvent):
+    historyCache.delete(payload.channel_id, [payload.message_id])
+
+
+@courtBot.event
+async def on_raw_bulk_message_delete(payload: discord.RawBulkMessageDeleteEvent):
+    historyCache.delete(payload.channel_id, payload.message_ids)
+
+
 async def handle_reply_render(init_message: Message, num_messages: int, song: str):
     if staff_only:
         if not init_message.author.guild_permissions.manage_messages:
@@ -428,47 +622,44 @@ async def handle_reply_render(init_message: Message, num_messages: int, song: st
 
     global renderQueue
     feedbackMessage = await init_message.reply(content="`Checking queue...`")
-    petitionsFromSameGuild = [
-        x for x in renderQueue if x.get_guild_id() == init_message.guild.id
-    ]
-    petitionsFromSameUser = [
-        x for x in renderQueue if x.get_user_id() == init_message.author.id
-    ]
+    messages = []
+    newRender = None
+    petitionsFromSameGuild = renderScheduler.getGuildCount(init_message.guild.id)
+    petitionsFromSameUser = renderScheduler.getUserCount(init_message.author.id)
     try:
-        if len(petitionsFromSameGuild) > max_per_guild:
+        if petitionsFromSameGuild > max_per_guild:
             raise Exception(f"Only up to {max_per_guild} renders per guild are allowed")
-        if len(petitionsFromSameUser) > max_per_user:
+        if petitionsFromSameUser > max_per_user:
             raise Exception(f"Only up to {max_per_user} renders per user are allowed")
         await feedbackMessage.edit(content="`Fetching messages...`")
         if num_messages == 0:
             raise Exception("Please specify the number of messages to be rendered!")
         if not (num_messages in range(1, 101)):
             raise Exception("Number of messages must be between 1 and 100")
-
-        courtMessages = []
-        discordMessages = []
+        # Checked again with the real messages once they're fetched
+        checkAdmission(admissionController.estimate(num_messages))
 
         # Get Message object of replied to message
         if init_message.reference is not None:
-            replied_to_message = await init_message.channel.fetch_message(init_message.reference.message_id)
-            discordMessages.append(replied_to_message)
+            with metrics.HISTORY_FETCH_SECONDS.time(command="reply"):
+                replied_to_message = await historyCache.getMessage(
+                    init_message.channel, init_message.reference.message_id
+                )
         else:
             await feedbackMessage.edit(content="Please reply to the message you want to the render to stop at!")
             return
 
-        # note that discordMessages is in new -> old order, and in the rendering process will be flipped from
+        # note that messages is in new -> old order, and in the rendering process will be flipped from
         # old -> new
-        discordMessages += [
-            message
-            async for message in init_message.channel.history(
-                limit=num_messages - 1, oldest_first=False, before=replied_to_message
+        with metrics.HISTORY_FETCH_SECONDS.time(command="reply"):
+            messages = [replied_to_message] + await historyCache.getHistory(
+                init_message.channel, num_messages - 1, before=replied_to_message.id, command="reply"
             )
-        ]
-
-        for discordMessage in discordMessages:
-            message = Message(discordMessage)
-            if message.text.strip():
-                courtMessages.insert(0, message.to_Comment())
+        messages = [message for message in messages if message.text.strip()]
+        with metrics.EVIDENCE_DOWNLOAD_SECONDS.time():
+            await evidenceDownloader.download(messages)
+        # History is newest first, scenes go oldest first
+        courtMessages = [message.to_Comment() for message in reversed(messages)]
 
         if len(courtMessages) < 1:
             raise Exception("There should be at least one person in the conversation.")
@@ -480,154 +671,450 @@ async def handle_reply_render(init_message: Message, num_messages: int, song: st
             music=song,
             discordReply=init_message,
         )
-        renderQueue.append(newRender)
+        newRender.cacheKey = await renderCache.getKey(
+            courtMessages, newRender.music_code, evidenceDownloader.cache
+        )
+        await enqueueRender(newRender)
+        metrics.ADMISSIONS_TOTAL.inc(result="accepted")
 
         lastRender = time.time()
 
     except Exception as exception:
+        metrics.ADMISSIONS_TOTAL.inc(result="refused")
         traceback.print_exc()
         print(exception)
+        if newRender not in renderQueue:
+            # It was never queued, nothing else will release the evidence it holds
+            evidenceDownloader.cache.release([message.evidence for message in messages])
         exceptionEmbed = discord.Embed(description=str(exception), color=0xFF0000)
         await feedbackMessage.edit(content="", embed=exceptionEmbed)
         addToDeletionQueue(feedbackMessage)
 
 
-@tasks.loop(minutes=5)
-async def garbageCollection():
-    gc.collect()
-    print("Garbage collected")
+def checkAdmission(cost):
+    # Raises when the queue can't take a render of this (memory, disk) cost right now
+    if not admissionController.fits(*cost):
+        wait = admissionController.getWait(*cost, getFinishTimes())
+        raise Exception(f"The queue is full right now, please try again in {formatDuration(wait)}")
+
+
+async def enqueueRender(render: Render, admit: bool = True):
+    # Restored renders were admitted by the previous run, admit=False only counts their cost
+    if queueChanged is None:
+        # Checked first, nothing may be queued that the pipeline would never pick up
+        raise Exception("The bot is still starting, please try again in a moment")
+    cost = admissionController.getCost(render)
+    if admit:
+        checkAdmission(cost)
+    render.compact()
+    size = scratchSpace.estimate(len(render.getMessages()))
+    if not await scratchSpace.reserve(render.get_id(), size, scratch_wait):
+        raise Exception("The bot is running out of disk space, please try again later")
+    try:
+        admissionController.add(render, cost)
+        render.outputFilename = scratchSpace.create(render.get_id())
+    except Exception:
+        # Not queued, its space is given back. The caller releases its evidence
+        scratchSpace.release(render.get_id())
+        admissionController.remove(render.get_id())
+        raise
+    if render.getFeedbackMessage() is not None:
+        asyncio.create_task(addReaction(render.getFeedbackMessage(), CANCEL_EMOJI))
+    render.queuedTime = time.monotonic()
+    renderQueue.append(render)
+    renderScheduler.add(render)
+    jobStore.saveRender(render)
+    queueChanged.set()
+    # The same scene was rendered recently, at the quality it would get now or better: it can be uploaded right away
+    minimumScale, _ = qualityGovernor.choose(render.getMessages(), len(renderScheduler), getBacklogWait())
+    render.estimatedSeconds = costModel.estimate(render.getMessages(), minimumScale)
+    if await renderCache.fetch(render, minimumScale, qualityGovernor.maxScale):
+        await renderCache.fetchFitted(render)
+        render.setState(State.RENDERED)
+        handleRenderStateChange(render)
+        return
+    # The same scene is being rendered right now, this render will get a copy of it
+    leader = renderCache.attach(render)
+    if leader is not None:
+        render.setState(leader.getState())
+        return
+    renderScheduler.push(render)
+    dispatchRenders()
+
+
+def dispatchRenders():
+    # Hands queued renders to idle workers, called whenever a render is queued or a worker is freed
+    while renderPool.hasIdleWorker():
+        render = renderScheduler.next()
+        if render is None:
+            break
+        if not render.transcodeOnly:
+            render.resolutionScale, render.scaleReason = qualityGovernor.choose(
+                render.getMessages(), len(renderScheduler), getBacklogWait()
+            )
+            render.estimatedSeconds = costModel.estimate(render.getMessages(), render.resolutionScale)
+            render.startTime = time.monotonic()
+            metrics.QUEUE_WAIT_SECONDS.observe(render.startTime - render.queuedTime)
+        if not renderPool.submit(render):
+            renderScheduler.pushFront(render)
+            break
+
+
+def onRenderStateChange(render: Render):
+    # Called from the render pool's monitor thread
+    if eventLoop is not None:
+        eventLoop.call_soon_threadsafe(handleRenderStateChange, render)
+
+
+def onWorkerReady():
+    # Called from the render pool's monitor thread
+    if eventLoop is not None:
+        eventLoop.call_soon_threadsafe(dispatchRenders)
+
+
+def handleRenderStateChange(render: Render):
+    state = render.getState()
+    if render.cancelled:
+        # A result that was already on its way when the render was cancelled
+        if state == State.RENDERED:
+            clean([], render.getOutputFilename())
+            if render.fittedFilename is not None:
+                clean([], render.fittedFilename)
+        return
+    if state == State.INPROGRESS:
+        for follower in renderCache.getFollowers(render):
+            follower.setState(State.INPROGRESS)
+    elif state == State.RENDERED:
+        # Marked as uploading right away, so a late notification can't queue it twice
+        render.setState(State.UPLOADING)
+        scratchSpace.update(render.get_id())
+        if render.startTime is not None and not render.transcodeOnly:
+            costModel.observe(
+                render.getMessages(), render.resolutionScale, time.monotonic() - render.startTime
+            )
+            jobStore.addRenderTime(
+                *costModel.getFeatures(render.getMessages(), render.resolutionScale),
+                time.monotonic() - render.startTime,
+            )
+            metrics.RENDER_SECONDS.observe(
+                time.monotonic() - render.startTime,
+                result="rendered",
+                scale=render.resolutionScale,
+            )
+        asyncio.create_task(completeRender(render))
+        dispatchRenders()
+    elif state == State.FAILED:
+        if render.startTime is not None:
+            metrics.RENDER_SECONDS.observe(
+                time.monotonic() - render.startTime,
+                result="failed",
+                scale=render.resolutionScale,
+            )
+        render.setState(State.DONE)
+        asyncio.create_task(failRender(render))
+        for follower in renderCache.detach(render):
+            follower.setState(State.DONE)
+            asyncio.create_task(failRender(follower))
+        dispatchRenders()
+    jobStore.saveRender(render)
+    queueChanged.set()
+
+
+async def completeRender(render: Render):
+    await renderCache.store(render)
+    for follower in renderCache.detach(render):
+        try:
+            await asyncio.to_thread(
+                linkFile, render.getOutputFilename(), follower.getOutputFilename()
+            )
+            follower.resolutionScale = render.resolutionScale
+            follower.scaleReason = "same as an identical render"
+            # The leader's smaller copy, stored above, if the follower's server has the same limit
+            await renderCache.fetchFitted(follower)
+            queueUpload(follower)
+        except Exception as exception:
+            print(f"Error: {exception}")
+            follower.setState(State.DONE)
+            asyncio.create_task(failRender(follower))
+    queueUpload(render)
+    queueChanged.set()
+
+
+def queueUpload(render: Render):
+    # Videos that never went through a worker (cache hits, copies for identical renders) may still
+    # be too big for their server, they go back to a worker once to be re-encoded smaller
+    if not render.fitChecked and os.path.getsize(render.getOutputFilename()) >= render.getSizeLimit():
+        render.transcodeOnly = True
+        render.setState(State.QUEUED)
+        renderScheduler.push(render)
+        dispatchRenders()
+        return
+    render.setState(State.UPLOADING)
+    uploadQueue.put_nowait(render)
+    jobStore.saveRender(render)
 
 
-@tasks.loop(seconds=1)
-async def deletionQueueLoop():
-    global deletionQueue
-    deletionQueueSize = len(deletionQueue)
-    # Delete message and remove from queue if remaining time is less than (or equal to) 0
-    if deletionQueueSize > 0:
-        for index in reversed(range(deletionQueueSize)):
-            if await deletionQueue[index].update():
-                deletionQueue.pop(index)
+async def failRender(render: Render):
+    metrics.RENDERS_TOTAL.inc(result="failed")
+    try:
+        newFeedback = f"""
+        `Fetching messages... Done!`
+        `Your video is being generated... Failed!`
+        """
+        feedbackUpdater.update(render, newFeedback)
+    except Exception as exception:
+        print(f"Error: {exception}")
+    finishRender(render)
+
+
+def finishRender(render: Render, state: State = State.DONE):
+    render.setState(state)
+    clean(render.getMessages(), render.getOutputFilename())
+    if render.fittedFilename is not None:
+        clean([], render.fittedFilename)
+    scratchSpace.release(render.get_id())
+    admissionController.remove(render.get_id())
+    addToDeletionQueue(render.getFeedbackMessage())
+    feedbackUpdater.forget(render)
+    jobStore.removeRender(render.get_id())
+    if render in renderQueue:
+        renderQueue.remove(render)
+        renderScheduler.remove(render)
+    queueChanged.set()
+
+
+def cancelRender(render: Render):
+    # Returns False when it's too late, once the video is being uploaded
+    if render.cancelled or render.getState() not in (State.QUEUED, State.INPROGRESS, State.RENDERED):
+        return False
+    render.cancelled = True
+    renderScheduler.discard(render)
+    if render.leader is not None:
+        renderCache.leave(render)
+    else:
+        renderPool.cancel(render)
+        requeueFollowers(renderCache.detach(render))
+    metrics.RENDERS_TOTAL.inc(result="cancelled")
+    newFeedback = f"""
+    `Fetching messages... Done!`
+    `Your video is being generated... Cancelled!`
+    """
+    feedbackUpdater.update(render, newFeedback)
+    finishRender(render, State.CANCELLED)
+    dispatchRenders()
+    return True
+
+
+def requeueFollowers(followers: List[Render]):
+    # The render they were waiting for was cancelled, the first one does the work instead
+    for follower in followers:
+        follower.leader = None
+        leader = renderCache.attach(follower)
+        if leader is None:
+            follower.setState(State.QUEUED)
+            renderScheduler.push(follower)
+        else:
+            follower.setState(leader.getState())
 
 
-@tasks.loop(seconds=5)
-async def renderQueueLoop():
-    global renderQueue
-    renderQueueSize = len(renderQueue)
-    await changeActivity(f"{prefix}help | queue: {renderQueueSize}")
-    for positionInQueue, render in enumerate(iterable=renderQueue, start=1):
+async def addReaction(message: discord.Message, emoji: str):
+    try:
+        await message.add_reaction(emoji)
+    except Exception as exception:
+        print(f"Error: {exception}")
+
+
+async def uploadLoop():
+    # upload_concurrency of these run at the same time, each one uploading a render at a time
+    while True:
+        render = await uploadQueue.get()
         try:
-            if render.getState() == State.QUEUED:
-                newFeedback = f"""
-                `Fetching messages... Done!`
-                `Position in the queue: #{(positionInQueue)}`
-                """
-                await render.updateFeedback(newFeedback)
-
-            if render.getState() == State.INPROGRESS:
-                newFeedback = f"""
-                `Fetching messages... Done!`
-                `Your video is being generated...`
-                """
-                await render.updateFeedback(newFeedback)
-
-            if render.getState() == State.FAILED:
-                newFeedback = f"""
-                `Fetching messages... Done!`
-                `Your video is being generated... Failed!`
-                """
-                await render.updateFeedback(newFeedback)
-                render.setState(State.DONE)
-
-            if render.getState() == State.RENDERED:
-                newFeedback = f"""
-                `Fetching messages... Done!`
-                `Your video is being generated... Done!`
-                `Uploading file to Discord...`
-                """
-                await render.updateFeedback(newFeedback)
-
-                render.setState(State.UPLOADING)
-
-                # If the file size is lower than the maximun file size allowed in this guild, upload it to Discord
-                fileSize = os.path.getsize(render.getOutputFilename())
-                if fileSize < render.getChannel().guild.filesize_limit:
-                    await render.reply(
-                        content=render.getUser().mention,
-                        file=discord.File(render.getOutputFilename()),
-                    )
-                    render.setState(State.DONE)
+            await uploadRender(render)
+            metrics.RENDERS_TOTAL.inc(result="uploaded")
+        except Exception as exception:
+            metrics.RENDERS_TOTAL.inc(result="upload_failed")
+            print(f"Error: {exception}")
+        finally:
+            finishRender(render)
+
+
+async def uploadRender(render: Render):
+    newFeedback = f"""
+    `Fetching messages... Done!`
+    `Your video is being generated... Done!`
+    `Uploading file to Discord...`
+    """
+    feedbackUpdater.update(render, newFeedback)
+
+    # If the file size is lower than the maximun file size allowed in this guild, upload it to Discord.
+    # Videos too big for it were already re-encoded by a worker if it was possible
+    fileSize = os.path.getsize(render.getUploadFilename())
+    metrics.VIDEO_BYTES.observe(fileSize)
+    if fileSize < render.getSizeLimit():
+        with metrics.UPLOAD_SECONDS.time(destination="discord"):
+            await retry(
+                lambda: render.reply(
+                    content=render.getUser().mention,
+                    file=discord.File(render.getUploadFilename()),
+                ),
+                attempts=upload_retries,
+            )
+        newFeedback = f"""
+        `Fetching messages... Done!`
+        `Your video is being generated... Done!`
+        `Uploading file to Discord... Done!`
+        """
+        feedbackUpdater.update(render, newFeedback)
+    else:
+        try:
+            newFeedback = f"""
+            `Fetching messages... Done!`
+            `Your video is being generated... Done!`
+            `Video file too big for you server! {round(fileSize / 1000000, 2)} MB`
+            `Trying to upload file to an external server...`
+            """
+            feedbackUpdater.update(render, newFeedback)
+            with metrics.UPLOAD_SECONDS.time(destination="external"):
+                url = await retry(
+                    lambda: externalUploader.upload(render.getUploadFilename()),
+                    attempts=upload_retries,
+                )
+            newFeedback = f"""
+            `Fetching messages... Done!`
+            `Your video is being generated... Done!`
+            `Video file too big for you server! {round(fileSize / 1000000, 2)} MB`
+            `Trying to upload file to an external server... Done!`
+            """
+            feedbackUpdater.update(render, newFeedback)
+            await render.reply(
+                content=f"{render.getUser().mention}\n{url}\n{externalUploader.notice}"
+            )
+
+        except Exception as exception:
+            newFeedback = f"""
+            `Fetching messages... Done!`
+            `Your video is being generated... Done!`
+            `Video file too big for you server! {round(fileSize / 1000000, 2)} MB`
+            `Trying to upload file to an external server... Failed!`
+            """
+            feedbackUpdater.update(render, newFeedback)
+            exceptionEmbed = discord.Embed(
+                description=str(exception), color=0xFF0000
+            )
+            exceptionMessage = await render.reply(
+                embed=exceptionEmbed
+            )
+            addToDeletionQueue(exceptionMessage)
+
+
+async def renderQueueLoop():
+    # Refreshes the activity and the feedback of renders waiting for a worker, only when the queue changed
+    while True:
+        await queueChanged.wait()
+        queueChanged.clear()
+        renderQueueSize = len(renderQueue)
+        await changeActivity(f"{prefix}help | queue: {renderQueueSize}")
+        order = renderScheduler.getOrder()
+        # Positions are counted within each guild, the ETA takes every guild into account
+        guildCounts = Counter()
+        positions = {}
+        for render in order:
+            guildCounts[render.get_guild_id()] += 1
+            positions[render] = guildCounts[render.get_guild_id()]
+        estimates = getEstimates(order)
+        for render in list(renderQueue):
+            try:
+                if render.getState() == State.QUEUED:
+                    # Renders waiting for an identical one share its position
+                    positionInQueue = positions.get(render.leader or render, 1)
+                    estimate = estimates.get(render.leader or render)
+                    eta = f" (ETA: {formatDuration(estimate)})" if estimate is not None else ""
                     newFeedback = f"""
                     `Fetching messages... Done!`
-                    `Your video is being generated... Done!`
-                    `Uploading file to Discord... Done!`
+                    `Position in the queue: #{(positionInQueue)}{eta}`
                     """
-                    await render.updateFeedback(newFeedback)
-                else:
-                    try:
-                        newFeedback = f"""
-                        `Fetching messages... Done!`
-                        `Your video is being generated... Done!`
-                        `Video file too big for you server! {round(fileSize / 1000000, 2)} MB`
-                        `Trying to upload file to an external server...`
-                        """
-                        await render.updateFeedback(newFeedback)
-                        with open(render.getOutputFilename(), "rb") as videoFile:
-                            files = {"files[]": (render.getOutputFilename(), videoFile)}
-                            response = (
-                                requests.post(
-                                    "https://uguu.se/upload.php?output=text",
-                                    files=files,
-                                )
-                                .content.decode("utf-8")
-                                .strip()
-                            )
-                            # parsed_response = json.loads(response)
-                            url = response
-                            newFeedback = f"""
-                            `Fetching messages... Done!`
-                            `Your video is being generated... Done!`
-                            `Video file too big for you server! {round(fileSize / 1000000, 2)} MB`
-                            `Trying to upload file to an external server... Done!`
-                            """
-                            await render.updateFeedback(newFeedback)
-                            await render.reply(
-                                content=f"{render.getUser().mention}\n{url}\n_This video will be deleted in 48 hours_"
-                            )
-                            render.setState(State.DONE)
-
-                    except Exception as exception:
-                        newFeedback = f"""
-                        `Fetching messages... Done!`
-                        `Your video is being generated... Done!`
-                        `Video file too big for you server! {round(fileSize / 1000000, 2)} MB`
-                        `Trying to upload file to an external server... Failed!`
-                        """
-                        await render.updateFeedback(newFeedback)
-                        exceptionEmbed = discord.Embed(
-                            description=exception, color=0xFF0000
-                        )
-                        exceptionMessage = await render.reply(
-                            embed=exceptionEmbed
-                        )
-                        addToDeletionQueue(exceptionMessage)
-                        render.setState(State.DONE)
+                    feedbackUpdater.update(render, newFeedback, positionOnly=True)
+
+                if render.getState() == State.INPROGRESS:
+                    newFeedback = f"""
+                    `Fetching messages... Done!`
+                    `Your video is being generated...`
+                    """
+                    feedbackUpdater.update(render, newFeedback)
+            except Exception as exception:
+                print(f"Error: {exception}")
+
+
+def getEstimates(order: List[Render]):
+    # Expected seconds until each waiting render is done, if they are started in this order
+    now = time.monotonic()
+    workers = [
+        max(0.0, render.estimatedSeconds - (now - render.startTime))
+        for render in renderQueue
+        if render.getState() == State.INPROGRESS
+        and render.startTime is not None
+        and render.estimatedSeconds is not None
+        and render.leader is None
+    ]
+    workers = sorted(workers)[: renderPool.capacity]
+    workers += [0.0] * (renderPool.capacity - len(workers))
+    heapq.heapify(workers)
+    estimates = {}
+    for render in order:
+        finished = heapq.heappop(workers) + (render.estimatedSeconds or 0)
+        heapq.heappush(workers, finished)
+        estimates[render] = finished
+    return estimates
+
+
+def getBacklogWait():
+    # Seconds until the waiting renders are expected to leave a worker free
+    return renderScheduler.getBacklogSeconds() / renderPool.capacity
+
+
+def getFinishTimes():
+    # Expected seconds until each render in the queue is done, by job id
+    now = time.monotonic()
+    estimates = getEstimates(renderScheduler.getOrder())
+    finishTimes = {}
+    for render in renderQueue:
+        # Renders waiting for an identical one are done with it
+        source = render.leader or render
+        if source in estimates:
+            finishTimes[render.get_id()] = estimates[source]
+        elif (
+            source.getState() == State.INPROGRESS
+            and source.startTime is not None
+            and source.estimatedSeconds is not None
+        ):
+            finishTimes[render.get_id()] = max(0.0, source.estimatedSeconds - (now - source.startTime))
+        else:
+            finishTimes[render.get_id()] = 0.0
+    return finishTimes
 
-        except Exception as exception:
-            print(f"Error: {exception}")
-            try:
-                render.setState(State.DONE)
-            except:
-                pass
-        finally:
-            if render.getState() == State.DONE:
-                clean(render.getMessages(), render.getOutputFilename())
-                addToDeletionQueue(render.getFeedbackMessage())
 
-    # Remove from queue if state is DONE
-    if renderQueueSize > 0:
-        for index in reversed(range(renderQueueSize)):
-            if renderQueue[index].getState() == State.DONE:
-                renderQueue.pop(index)
+def formatDuration(seconds: float):
+    if seconds < 60:
+        return "less than a minute"
+    minutes = round(seconds / 60)
+    return f"about {minutes} minute{'s' if minutes > 1 else ''}"
+
+
+@courtBot.event
+async def setup_hook():
+    # Called once, after logging in and before connecting to the gateway
+    if intents.message_content:
+        flags = (await courtBot.application_info()).flags
+        if not (flags.gateway_message_content or flags.gateway_message_content_limited):
+            # Connecting would fail, and an empty cache would lose the lines of every render
+            print(
+                "Error: the Message Content intent isn't enabled in the developer portal, "
+                "the history cache is disabled"
+            )
+            intents.message_content = False
+            historyCache.maxMessages = 0
+    # Before the gateway is connected, so no command can come in before the pipeline is there
+    await startPipeline()
 
 
 @courtBot.event
@@ -639,55 +1126,188 @@ async def on_ready():
         f"Logged in as {courtBot.user.name}#{courtBot.user.discriminator} ({courtBot.user.id})"
     )
     currentActivityText = f"{prefix}help"
-    renderQueueLoop.start()
-    deletionQueueLoop.start()
+    historyCache.clear()
+    # on_ready is also called after reconnecting, renders must only be restored once.
+    # Restoring needs the guilds and members the gateway sends before on_ready
+    global restored
+    if not restored:
+        restored = True
+        await restoreQueues()
+
+
+async def startPipeline():
+    # Also used by benchmark.py, which runs the pipeline without connecting to Discord
+    global eventLoop, uploadQueue, queueChanged
+    eventLoop = asyncio.get_running_loop()
+    uploadQueue = asyncio.Queue()
+    queueChanged = asyncio.Event()
+    eventLoop.create_task(renderQueueLoop())
+    for _ in range(upload_concurrency):
+        eventLoop.create_task(uploadLoop())
+    eventLoop.create_task(deletionScheduler.run())
+    if metrics_config.get("enabled"):
+        metrics.collectors.append(collectMetrics)
+        await metrics.startServer(
+            host=metrics_config.get("host") or "127.0.0.1",
+            port=metrics_config.get("port") or 9100,
+        )
+
+
+def collectMetrics():
+    # Queue gauges are computed when metrics are scraped, rather than on every change
+    states = [render.getState() for render in renderQueue]
+    for state in State:
+        metrics.QUEUE_DEPTH.set(states.count(state), state=state.name)
+    metrics.GUILD_QUEUE_DEPTH.clear()
+    for guildId, count in renderScheduler.guildCounts.items():
+        metrics.GUILD_QUEUE_DEPTH.set(count, guild=guildId)
+    metrics.QUEUE_COST_BYTES.set(admissionController.memory, resource="memory")
+    metrics.QUEUE_COST_BYTES.set(admissionController.disk, resource="disk")
+    metrics.DELETIONS_PENDING.set(len(deletionScheduler))
+    metrics.RENDER_CACHE_LOOKUPS_TOTAL.set(renderCache.hits, outcome="hit")
+    metrics.RENDER_CACHE_LOOKUPS_TOTAL.set(renderCache.misses, outcome="miss")
+    metrics.RENDER_CACHE_LOOKUPS_TOTAL.set(renderCache.joins, outcome="joined")
+
+
+async def restoreQueues():
+    # Picks up the renders and deletions left by the previous run
+    for channelId, messageId, deadline in jobStore.loadDeletions():
+        try:
+            channel = courtBot.get_channel(channelId) or await courtBot.fetch_channel(channelId)
+            deletionScheduler.add(
+                channel.get_partial_message(messageId), max(0, deadline - time.time())
+            )
+        except Exception as exception:
+            print(f"Error: {exception}")
+            jobStore.removeDeletion(channelId, messageId)
+
+    storedRenders = jobStore.loadRenders()
+    scratchSpace.sweep(
+        {scratchSpace.getPath(stored["id"]) for stored in storedRenders}
+        | {os.path.abspath(stored["output_filename"]) for stored in storedRenders},
+        legacy=jobStore.created,
+    )
+    if storedRenders:
+        print(f"Restoring {len(storedRenders)} render(s)")
+    for stored in storedRenders:
+        try:
+            await restoreRender(stored)
+        except Exception as exception:
+            # Its channel or user is gone, there's nowhere to tell it failed
+            print(f"Error: {exception}")
+            jobStore.removeRender(stored["id"])
+    renderPool.endRestore()
+
+
+async def restoreRender(stored: dict):
+    channel = courtBot.get_channel(stored["channel_id"]) or await courtBot.fetch_channel(
+        stored["channel_id"]
+    )
+    user = channel.guild.get_member(stored["user_id"]) or await courtBot.fetch_user(
+        stored["user_id"]
+    )
+    try:
+        feedbackMessage = await channel.fetch_message(stored["feedback_message_id"])
+    except Exception:
+        # It will be posted again with the next update
+        feedbackMessage = None
+    # Evidence files are still in the cache unless it was cleared, without them the message is rendered as text
+    for comment in stored["messages"]:
+        if comment.evidence_path is not None:
+            comment.evidence_path = evidenceDownloader.cache.acquirePath(comment.evidence_path)
+
+    render = Render(
+        state=State.QUEUED,
+        feedbackMessage=feedbackMessage,
+        messages=stored["messages"],
+        music=stored["music_code"],
+        channel=channel,
+        user=user,
+        jobId=stored["id"],
+    )
+    render.outputFilename = stored["output_filename"]
+    render.cacheKey = stored["cache_key"]
+
+    state = stored["state"]
+    if state == State.FAILED:
+        renderQueue.append(render)
+        renderScheduler.add(render)
+        render.setState(State.DONE)
+        await failRender(render)
+        return
+    if state in (State.DONE, State.CANCELLED):
+        renderQueue.append(render)
+        renderScheduler.add(render)
+        finishRender(render)
+        return
+    try:
+        if state in (State.RENDERED, State.UPLOADING) and os.path.exists(
+            render.getOutputFilename()
+        ):
+            # Already rendered, only the upload is left
+            scratchSpace.adopt(render.get_id())
+            admissionController.add(render, admissionController.getCost(render))
+            renderQueue.append(render)
+            renderScheduler.add(render)
+            queueUpload(render)
+        else:
+            # Interrupted renders are started again
+            await enqueueRender(render, admit=False)
+    except Exception as exception:
+        # Told like any other failure, finishRender releases what it holds
+        print(f"Error: {exception}")
+        await failRender(render)
 
 
 def clean(thread: List[Comment], filename):
     try:
         os.remove(filename)
+    except FileNotFoundError:
+        # Cancelled before it was rendered
+        pass
     except Exception as exception:
         print(f"Error: {exception}")
     try:
-        for comment in thread:
-            if comment.evidence_path is not None:
-                os.remove(comment.evidence_path)
+        # Evidence files belong to the cache, they are only released here
+        evidenceDownloader.cache.release(
+            [comment.evidence_path for comment in thread]
+        )
     except Exception as exception:
         print(f"Error: {exception}")
 
 
-def renderThread():
-    global renderQueue
-    while True:
-        time.sleep(2)
-        try:
-            for render in renderQueue:
-                if render.getState() == State.QUEUED:
-                    render.setState(State.INPROGRESS)
-                    try:
-                        render_comment_list(
-                            render.getMessages(),
-                            render.getOutputFilename(),
-                            music_code=render.music_code,
-                            resolution_scale=2,
-                        )
-                        render.setState(State.RENDERED)
-                    except Exception as exception:
-                        print(f"Error: {exception}")
-                        render.setState(State.FAILED)
-                    finally:
-                        break
-        except Exception as exception:
-            print(f"Error: {exception}")
+if __name__ == "__main__":
+    # Only here: render workers and the evidence pool are spawned, and re-import this file
+    # as __mp_main__ without running this block
+    if not loadConfig():
+        exit()
 
+    if spool_config.get("dir"):
+        renderPool = SpoolPool(
+            spool_config["dir"],
+            capacity=spool_config.get("capacity") or 8,
+            onStateChange=onRenderStateChange,
+            leaseTime=spool_config.get("lease_time") or 60,
+        )
+    else:
+        # Rendering happens in separate processes, so it doesn't fight with the bot for the GIL
+        maxJobs = memory_config.get("worker_max_jobs")
+        maxRss = memory_config.get("worker_max_rss")
+        renderPool = RenderPool(
+            render_workers,
+            onStateChange=onRenderStateChange,
+            codec=transcode_codec,
+            maxJobs=50 if maxJobs is None else maxJobs,
+            maxRss=(1500 if maxRss is None else maxRss) * 1000000,
+            memoryBudget=(memory_config.get("budget") or 0) * 1000000,
+            renderMemory=(memory_config.get("render_estimate") or 800) * 1000000,
+            onWorkerReady=onWorkerReady,
+            assetDirectory=assets_config.get("dir", "asset_cache"),
+        )
+    renderPool.start()
 
-backgroundThread = threading.Thread(target=renderThread, name="RenderThread")
-backgroundThread.start()
-# Even while threads in python are not concurrent in CPU, the rendering process may use a lot of disk I/O so having two threads
-# May help speed up things
-# backgroundThread2 = threading.Thread(target=renderThread, name="RenderThread2")
-# backgroundThread2.start()
+    jobStore.start()
 
-courtBot.run(token)
-backgroundThread.join()
-# backgroundThread2.join()
+    courtBot.run(token)
+    renderPool.stop()
+    jobStore.stop()
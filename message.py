@@ -1,58 +1,87 @@
 from discord import Message
 import re
 from emoji.core import demojize
-import requests
-from objection_engine.beans.comment import Comment
+from comment import Comment
+from evidence import getEvidenceKey
+from typing import List, Optional
+
+# Custom static and animated emojis, links, and the zero width space in @everyone and @here,
+# replaced in a single pass
+CLEANUP_PATTERN = re.compile(
+    r"(?P<emoji><a?(?P<name>:\w{2,32}:)\d{18,19}>)|(?P<link>https?\S*)|(?P<space>\u200b)"
+)
+# Tag appended to the text for every attachment, by lowercased extension
+ATTACHMENT_TAGS = {
+    "jpg": " (image)",
+    "jpeg": " (image)",
+    "png": " (image)",
+    "gif": " (gif)",
+    "gifv": " (gif)",
+    "mp4": " (video)",
+    "webm": " (video)",
+    "mp3": " (audio)",
+    "wav": " (audio)",
+    "ogg": " (audio)",
+}
+
+
+def replaceMatch(match: re.Match):
+    if match.group("emoji"):
+        return match.group("name")
+    if match.group("link"):
+        return "(link)"
+    return ""
+
+
+def cleanText(text: str):
+    text = CLEANUP_PATTERN.sub(replaceMatch, text)
+    # Stock emojis are never ASCII
+    if not text.isascii():
+        text = demojize(text)
+    return text
+
+
+def convertMessages(updates: List[Message]):
+    # Converts a whole page of history, looking up each author only once
+    users = {}
+    messages = []
+    for update in updates:
+        user = users.get(update.author.id)
+        if user is None:
+            user = users[update.author.id] = getUser(update)
+        messages.append(Message(update, user))
+    return messages
+
+
+def getUser(update: Message):
+    try:
+        return User(update.guild.get_member(update.author.id))
+    except Exception as e:
+        print(e)
+        return User(update.author)
 
 
 class Message:
-    def __init__(self, update: Message):
-        try:
-            self.user = User(update.guild.get_member(update.author.id))
-        except Exception as e:
-            self.user = User(update.author)
-            print(e)
+    def __init__(self, update: Message, user: Optional["User"] = None):
+        self.id = update.id
+        self.user = user if user is not None else getUser(update)
+        # Evidence is only located here, it's downloaded afterwards by evidence.EvidenceDownloader
         self.evidence = None
-        tmp = update.clean_content
-        tmp = re.sub(r"(https?)\S*", "(link)", tmp)  # links
-        tmp = demojize(tmp)
-        tmp = re.sub(
-            r"<[a]?(:\w{2,32}:)\d{18,19}>", r"\1", tmp
-        )  # custom static and animated emojis
-        # tmp = re.sub(r':\w{2,32}:', '', tmp) # stock emojis
-        tmp = re.sub(r"​", "", tmp)  # @everyone, @here
+        self.evidenceUrl = None
+        self.evidenceKey = None
+        tmp = cleanText(update.clean_content)
         for file in update.attachments:  # attachments
-            if file.filename.split(".")[-1] in {
-                "jpg",
-                "jpeg",
-                "JPG",
-                "JPEG",
-                "png",
-                "PNG",
-            }:
-                tmp += " (image)"
-                name = str(file.id) + ".png"
-                response = requests.get(file.url)
-                with open(name, "wb") as file:
-                    file.write(response.content)
-                self.evidence = name
-            elif file.filename.split(".")[-1] in {"gif", "gifv"}:
-                tmp += " (gif)"
-            elif file.filename.split(".")[-1] in {"mp4", "webm"}:
-                tmp += " (video)"
-            elif file.filename.split(".")[-1] in {"mp3", "wav", "ogg"}:
-                tmp += " (audio)"
-            else:
-                tmp += " (file)"
+            tag = ATTACHMENT_TAGS.get(file.filename.rsplit(".", 1)[-1].lower(), " (file)")
+            tmp += tag
+            if tag == " (image)":
+                self.evidenceUrl = file.url
+                self.evidenceKey = getEvidenceKey(attachmentId=file.id)
         for embed in update.embeds:
             if embed.type == "image":
                 tmp += " (image)"
                 url = embed.thumbnail.proxy_url
-                name = url.split("/")[-1]
-                response = requests.get(url)
-                with open(name, "wb") as file:
-                    file.write(response.content)
-                self.evidence = name
+                self.evidenceUrl = url
+                self.evidenceKey = getEvidenceKey(url=url)
         self.text = tmp
 
     def to_Comment(self):
@@ -0,0 +1,192 @@
+import bisect
+import time
+from contextlib import contextmanager
+
+from aiohttp import web
+
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+SIZE_BUCKETS = (1e5, 1e6, 4e6, 8e6, 25e6, 50e6, 100e6, 500e6)
+MEMORY_BUCKETS = (1e6, 10e6, 50e6, 100e6, 250e6, 500e6, 1e9, 2e9, 4e9, 8e9)
+
+
+def escapeLabel(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def formatLabels(labelNames, labelValues, extra=()):
+    pairs = list(zip(labelNames, labelValues)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{escapeLabel(value)}"' for name, value in pairs) + "}"
+
+
+class Metric:
+    type = ""
+
+    def __init__(self, name: str, description: str, labels=()):
+        self.name = name
+        self.description = description
+        self.labelNames = tuple(labels)
+        self.values = {}
+        registry.append(self)
+
+    def getKey(self, labels: dict):
+        return tuple(labels.get(name, "") for name in self.labelNames)
+
+    def clear(self):
+        self.values = {}
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.type}"]
+        for key, value in list(self.values.items()):
+            lines.append(f"{self.name}{formatLabels(self.labelNames, key)} {value}")
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.getKey(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def set(self, value: float, **labels):
+        # For totals already counted somewhere else
+        self.values[self.getKey(labels)] = value
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        self.values[self.getKey(labels)] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, description: str, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self.getKey(labels)
+        if key not in self.values:
+            # Count per bucket (plus +Inf), sum, count
+            self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        counts, _, _ = entry = self.values[key]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.type}"]
+        for key, (counts, total, count) in list(self.values.items()):
+            cumulative = 0
+            for bound, bucketCount in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucketCount
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                lines.append(
+                    f"{self.name}_bucket{formatLabels(self.labelNames, key, [('le', le)])} {cumulative}"
+                )
+            lines.append(f"{self.name}_sum{formatLabels(self.labelNames, key)} {total}")
+            lines.append(f"{self.name}_count{formatLabels(self.labelNames, key)} {count}")
+        return lines
+
+
+registry = []
+# Called before every scrape, to refresh gauges that are cheaper to compute on demand
+collectors = []
+
+
+def renderMetrics():
+    for collector in collectors:
+        try:
+            collector()
+        except Exception as exception:
+            print(f"Error: {exception}")
+    lines = []
+    for metric in registry:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+async def handleMetrics(request):
+    return web.Response(text=renderMetrics(), content_type="text/plain", charset="utf-8")
+
+
+async def startServer(host: str = "127.0.0.1", port: int = 9100):
+    app = web.Application()
+    app.router.add_get("/metrics", handleMetrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    print(f"Metrics available at http://{host}:{port}/metrics")
+    return runner
+
+
+HISTORY_FETCH_SECONDS = Histogram(
+    "aabot_history_fetch_seconds", "Time spent fetching the message history of a render", ["command"]
+)
+MESSAGE_CONVERSION_SECONDS = Histogram(
+    "aabot_message_conversion_seconds", "Time spent converting Discord messages to comments", ["command"]
+)
+EVIDENCE_DOWNLOAD_SECONDS = Histogram(
+    "aabot_evidence_download_seconds", "Time spent downloading the evidence of a render"
+)
+QUEUE_WAIT_SECONDS = Histogram(
+    "aabot_queue_wait_seconds", "Time renders waited for a worker"
+)
+RENDER_SECONDS = Histogram(
+    "aabot_render_seconds", "Time workers spent on a render", ["result", "scale"]
+)
+VIDEO_BYTES = Histogram(
+    "aabot_video_bytes", "Size of the uploaded videos", buckets=SIZE_BUCKETS
+)
+UPLOAD_SECONDS = Histogram(
+    "aabot_upload_seconds", "Time spent uploading a video", ["destination"]
+)
+DISCORD_API_SECONDS = Histogram(
+    "aabot_discord_api_seconds", "Latency of the Discord API calls made by the pipeline", ["call"]
+)
+WORKER_MEMORY_BYTES = Histogram(
+    "aabot_worker_memory_bytes",
+    "Resident memory of render workers after a render, its growth during it and the worker's peak",
+    ["kind"],
+    buckets=MEMORY_BUCKETS,
+)
+WORKER_RECYCLES_TOTAL = Counter(
+    "aabot_worker_recycles_total", "Render workers restarted to give their memory back, by reason", ["reason"]
+)
+RENDERS_TOTAL = Counter(
+    "aabot_renders_total", "Renders that left the queue", ["result"]
+)
+ADMISSIONS_TOTAL = Counter(
+    "aabot_admissions_total", "Render requests, by outcome", ["result"]
+)
+QUEUE_DEPTH = Gauge(
+    "aabot_queue_depth", "Renders in the queue, by state", ["state"]
+)
+GUILD_QUEUE_DEPTH = Gauge(
+    "aabot_guild_queue_depth", "Renders in the queue, by guild", ["guild"]
+)
+QUEUE_COST_BYTES = Gauge(
+    "aabot_queue_cost_bytes", "Estimated memory and disk used by the renders in the queue", ["resource"]
+)
+DELETIONS_PENDING = Gauge(
+    "aabot_deletions_pending", "Messages waiting to be deleted"
+)
+HISTORY_CACHE_LOOKUPS_TOTAL = Counter(
+    "aabot_history_cache_lookups_total", "Message history lookups, by outcome", ["outcome"]
+)
+RENDER_CACHE_LOOKUPS_TOTAL = Counter(
+    "aabot_render_cache_lookups_total", "Render cache lookups, by outcome", ["outcome"]
+)
@@ -1,10 +1,10 @@
 import textwrap
 import traceback
-from datetime import datetime
 
-from discord import Interaction, Message
+from discord import Interaction, Message, User
+from discord.abc import Messageable
 from enum import Enum
-from objection_engine.beans.comment import Comment
+from comment import Comment
 from typing import List, Optional
 
 
@@ -15,6 +15,7 @@ class State(Enum):
     RENDERED = 3
     UPLOADING = 4
     DONE = 5
+    CANCELLED = 6
 
 
 class Render:
@@ -26,15 +27,55 @@ class Render:
         music: str,
         discordInteraction: Optional[Interaction] = None,
         discordReply: Optional[Message] = None,
+        channel: Optional[Messageable] = None,
+        user: Optional[User] = None,
+        jobId: Optional[int] = None,
     ):
         self.state = state
         self.discordInteraction = discordInteraction
         self.discordReply = discordReply
+        # Renders restored by jobstore.JobStore after a restart have neither an interaction
+        # nor a message to reply to, only the channel and the user who asked for them
+        self.channel = channel
+        self.user = user
+        self.jobId = jobId
+        # Set by compact(), the message the video is posted in reply to
+        self.replyTo = None
         self.feedbackMessage = feedbackMessage
         self.messages = messages
-        filename = datetime.now().strftime("%Y_%m_%d-%I_%M_%S_%p")
-        self.outputFilename = f"{filename}.mp4"
+        # Set when the render is queued, in its own directory from scratch.ScratchSpace
+        self.outputFilename = None
         self.music_code = music
+        # Picked by governor.QualityGovernor when the render is handed to a worker
+        self.resolutionScale = 2
+        self.scaleReason = None
+        self.queuedTime = None
+        self.startTime = None
+        # Set from costmodel.CostModel, scheduler.RenderScheduler orders the queue with them
+        self.estimatedSeconds = None
+        self.schedulingKey = None
+        # Set by rendercache.RenderCache, leader is the render doing the work for an identical scene
+        self.cacheKey = None
+        self.leader = None
+        # Set when the video was too big for the server and a smaller copy was made
+        self.fittedFilename = None
+        # Whether a worker already checked the video against the server's size limit
+        self.fitChecked = False
+        # Only make the smaller copy, the video itself was already rendered
+        self.transcodeOnly = False
+        # Set as soon as the render is cancelled, results still on their way are thrown away
+        self.cancelled = False
+
+    def compact(self):
+        # Queued renders only keep ids and the objects discord.py caches anyway, instead of the
+        # interaction or the command message with everything they reference
+        self.jobId = self.get_id()
+        self.channel = self.getChannel()
+        self.user = self.getUser()
+        if self.discordReply is not None:
+            self.replyTo = self.channel.get_partial_message(self.discordReply.id)
+        self.discordInteraction = None
+        self.discordReply = None
 
     def getStateString(self):
         if self.state == State.QUEUED:
@@ -49,6 +90,8 @@ class Render:
             return "Uploading"
         if self.state == State.DONE:
             return "Done"
+        if self.state == State.CANCELLED:
+            return "Cancelled"
 
     def getState(self):
         return self.state
@@ -56,14 +99,18 @@ class Render:
     def getUser(self):
         if self.discordInteraction is not None:
             return self.discordInteraction.user
-        else:
+        elif self.discordReply is not None:
             return self.discordReply.author
+        else:
+            return self.user
 
     def getChannel(self):
         if self.discordInteraction is not None:
             return self.discordInteraction.channel
-        else:
+        elif self.discordReply is not None:
             return self.discordReply.channel
+        else:
+            return self.channel
 
     def getFeedbackMessage(self):
         return self.feedbackMessage
@@ -74,14 +121,26 @@ class Render:
     def getOutputFilename(self):
         return self.outputFilename
 
+    def getUploadFilename(self):
+        if self.fittedFilename is not None:
+            return self.fittedFilename
+        return self.outputFilename
+
+    def getSizeLimit(self):
+        return self.getChannel().guild.filesize_limit
+
     def setState(self, state: State):
         self.state = state
 
     async def reply(self, **kwargs):
         if self.discordInteraction is not None:
             return await self.discordInteraction.followup.send(**kwargs)
-        else:
+        elif self.discordReply is not None:
             return await self.discordReply.reply(**kwargs)
+        elif self.replyTo is not None:
+            return await self.replyTo.reply(**kwargs)
+        else:
+            return await self.channel.send(**kwargs)
 
     async def edit(self, **kwargs):
         if self.discordInteraction is not None:
@@ -92,27 +151,34 @@ class Render:
     def get_guild_id(self):
         if self.discordInteraction is not None:
             return self.discordInteraction.guild_id
-        else:
+        elif self.discordReply is not None:
             return self.discordReply.guild.id
+        else:
+            return self.channel.guild.id
 
     def get_user_id(self):
         if self.discordInteraction is not None:
             return self.discordInteraction.user.id
-        else:
+        elif self.discordReply is not None:
             return self.discordReply.author.id
+        else:
+            return self.user.id
 
     def get_id(self):
         if self.discordInteraction is not None:
             return self.discordInteraction.id
-        else:
+        elif self.discordReply is not None:
             return self.discordReply.id
+        else:
+            return self.jobId
 
     async def updateFeedback(self, newContent: str):
         try:
             newContent = textwrap.dedent(newContent).strip("\n")
             # Feedback messages will only be updated if their content is different to the new Content, to avoid spamming Discord's API
             if self.feedbackMessage.content != newContent:
-                await self.feedbackMessage.edit(content=newContent)
+                # edit() returns the updated message, keeping it lets the check above work next time
+                self.feedbackMessage = await self.feedbackMessage.edit(content=newContent)
             # If it's unable to edit/get the feedback message, it will raise an exception and that means that it no longer exists
         except Exception as exception:
             # If it doesn't exist, we will repost it.
@@ -0,0 +1,212 @@
+import asyncio
+import hashlib
+import json
+import os
+import shutil
+from collections import OrderedDict
+from typing import List
+
+from comment import Comment
+from evidence import EvidenceCache
+from render import Render
+from transcode import CODECS
+
+# Videos are rendered as mp4, smaller copies can be any codec's format
+EXTENSIONS = {".mp4"} | {f".{codec['extension']}" for codec in CODECS.values()}
+
+
+def linkFile(source: str, destination: str):
+    # A hard link is free when both files are on the same disk, otherwise the file is copied
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+class RenderCache:
+    """
+    Finished videos on disk, keyed by a hash of everything that changes the output: the comments
+    (user, name, text and evidence content) and the music, plus the resolution scale they
+    were rendered at.
+    The smaller copy made of a video too big for a server is kept next to it, keyed by the
+    server's size limit, so the same scene isn't re-encoded again for servers with that limit.
+    Renders asking for a scene that's already being rendered are attached to that render
+    instead of being rendered again.
+    """
+
+    def __init__(self, directory: str = "render_cache", maxBytes: int = 2000000000):
+        self.directory = os.path.abspath(directory)
+        self.maxBytes = maxBytes
+        self.entries = OrderedDict()  # file name -> size in bytes, least recently used first
+        self.totalBytes = 0
+        self.inFlight = {}  # key -> render doing the actual work
+        self.followers = {}  # key -> renders waiting for it
+        self.hits = 0
+        self.misses = 0
+        self.joins = 0
+        os.makedirs(self.directory, exist_ok=True)
+        self.load()
+
+    def load(self):
+        files = []
+        for filename in os.listdir(self.directory):
+            path = os.path.join(self.directory, filename)
+            if filename.endswith(".part"):
+                os.remove(path)
+                continue
+            if os.path.splitext(filename)[1] in EXTENSIONS:
+                stat = os.stat(path)
+                files.append((stat.st_mtime, filename, stat.st_size))
+        for _, entry, size in sorted(files):
+            self.entries[entry] = size
+            self.totalBytes += size
+        self.evict()
+
+    def getPath(self, entry: str):
+        return os.path.join(self.directory, entry)
+
+    def getEntry(self, key: str, scale: int):
+        return f"{key}-{scale}.mp4"
+
+    def getFittedEntry(self, key: str, scale: int, sizeLimit: int, extension: str):
+        return f"{key}-{scale}-fit{sizeLimit}{extension}"
+
+    async def getKey(
+        self,
+        comments: List[Comment],
+        musicCode: str,
+        evidenceCache: EvidenceCache,
+    ):
+        digest = hashlib.sha256()
+        digest.update(json.dumps([musicCode]).encode("utf-8"))
+        for comment in comments:
+            evidenceHash = None
+            if comment.evidence_path is not None:
+                evidenceHash = await evidenceCache.getContentHash(comment.evidence_path)
+            digest.update(
+                json.dumps(
+                    [comment.user_id, comment.user_name, comment.text_content, evidenceHash]
+                ).encode("utf-8")
+            )
+        return digest.hexdigest()
+
+    async def fetch(self, render: Render, minimumScale: int, maximumScale: int):
+        # Copies the best cached video at minimumScale or above to the render's output file,
+        # returns False on a miss
+        for scale in range(maximumScale, minimumScale - 1, -1):
+            entry = self.getEntry(render.cacheKey, scale)
+            if entry not in self.entries:
+                continue
+            try:
+                await asyncio.to_thread(linkFile, self.getPath(entry), render.getOutputFilename())
+            except Exception as exception:
+                print(f"Error: {exception}")
+                self.entries.pop(entry, None)
+                continue
+            self.entries.move_to_end(entry)
+            render.resolutionScale = scale
+            render.scaleReason = "already rendered"
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    async def fetchFitted(self, render: Render):
+        # Gives a render too big for its server the smaller copy made earlier for a server with
+        # the same size limit, returns False if there's none
+        sizeLimit = render.getSizeLimit()
+        try:
+            if render.cacheKey is None or os.path.getsize(render.getOutputFilename()) < sizeLimit:
+                return False
+        except OSError as exception:
+            print(f"Error: {exception}")
+            return False
+        for extension in EXTENSIONS:
+            entry = self.getFittedEntry(render.cacheKey, render.resolutionScale, sizeLimit, extension)
+            if entry not in self.entries:
+                continue
+            # Named like transcode.fitToSize names it
+            fittedFilename = f"{os.path.splitext(render.getOutputFilename())[0]}-fit{extension}"
+            try:
+                await asyncio.to_thread(linkFile, self.getPath(entry), fittedFilename)
+            except Exception as exception:
+                print(f"Error: {exception}")
+                self.entries.pop(entry, None)
+                continue
+            self.entries.move_to_end(entry)
+            render.fittedFilename = fittedFilename
+            render.fitChecked = True
+            return True
+        return False
+
+    def attach(self, render: Render):
+        # Returns the render already working on the same scene, or None if this one has to do it
+        leader = self.inFlight.get(render.cacheKey)
+        if leader is None:
+            self.inFlight[render.cacheKey] = render
+            return None
+        self.followers.setdefault(render.cacheKey, []).append(render)
+        render.leader = leader
+        self.joins += 1
+        return leader
+
+    def getFollowers(self, render: Render):
+        if self.inFlight.get(render.cacheKey) is not render:
+            return []
+        return self.followers.get(render.cacheKey, [])
+
+    def leave(self, render: Render):
+        # A render that stopped waiting for its leader, because it was cancelled
+        followers = self.followers.get(render.cacheKey, [])
+        if render in followers:
+            followers.remove(render)
+        if not followers:
+            self.followers.pop(render.cacheKey, None)
+        render.leader = None
+
+    def detach(self, render: Render):
+        # Called once the render is finished, returns the renders that were waiting for it
+        if self.inFlight.get(render.cacheKey) is not render:
+            return []
+        del self.inFlight[render.cacheKey]
+        return self.followers.pop(render.cacheKey, [])
+
+    async def store(self, render: Render):
+        if render.cacheKey is None:
+            return
+        await self.add(self.getEntry(render.cacheKey, render.resolutionScale), render.getOutputFilename())
+        if render.fittedFilename is not None:
+            entry = self.getFittedEntry(
+                render.cacheKey,
+                render.resolutionScale,
+                render.getSizeLimit(),
+                os.path.splitext(render.fittedFilename)[1],
+            )
+            await self.add(entry, render.fittedFilename)
+
+    async def add(self, entry: str, filename: str):
+        if entry in self.entries:
+            return
+        temporaryPath = f"{self.getPath(entry)}.part"
+        try:
+            await asyncio.to_thread(linkFile, filename, temporaryPath)
+            os.replace(temporaryPath, self.getPath(entry))
+        except Exception as exception:
+            print(f"Error: {exception}")
+            return
+        size = os.path.getsize(self.getPath(entry))
+        self.entries[entry] = size
+        self.totalBytes += size
+        self.evict()
+
+    def evict(self):
+        while self.totalBytes > self.maxBytes and self.entries:
+            entry, size = self.entries.popitem(last=False)
+            self.totalBytes -= size
+            try:
+                os.remove(self.getPath(entry))
+            except Exception as exception:
+                print(f"Error: {exception}")
+
+    def getStats(self):
+        return f"{len(self.entries)} video(s), {round(self.totalBytes / 1000000, 2)} MB, {self.hits} hit(s), {self.misses} miss(es), {self.joins} joined render(s)"
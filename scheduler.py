@@ -0,0 +1,122 @@
+import heapq
+import itertools
+import time
+from collections import Counter, deque
+
+from render import Render
+
+
+class RenderScheduler:
+    """
+    Keeps the renders waiting for a worker per guild and serves the guilds in rounds: every
+    guild with waiting renders gets one render per round, so a single busy guild can't starve
+    the others. Within a guild, and between the guilds of a round, the render with the
+    earliest key goes first: the time it was queued plus costWeight times its expected render
+    time. Short renders get ahead of long ones, but a long render only gives way to renders
+    queued less than costWeight times its cost after it, so it can't starve. A costWeight of
+    0 serves every guild in FIFO order.
+    Active renders are also counted per guild and per user, so admission checks don't have
+    to scan the whole queue.
+    """
+
+    def __init__(self, costWeight: float = 1.0):
+        self.costWeight = costWeight
+        self.guildQueues = {}  # guild id -> heap of (key, sequence, render) waiting for a worker
+        self.round = set()  # guild ids with waiting renders that weren't served in this round yet
+        self.sequence = itertools.count()
+        self.guildCounts = Counter()
+        self.userCounts = Counter()
+
+    def add(self, render: Render):
+        # Counts a render from the moment it's queued until it's done
+        self.guildCounts[render.get_guild_id()] += 1
+        self.userCounts[render.get_user_id()] += 1
+
+    def remove(self, render: Render):
+        self.discard(render)
+        for counts, key in (
+            (self.guildCounts, render.get_guild_id()),
+            (self.userCounts, render.get_user_id()),
+        ):
+            counts[key] -= 1
+            if counts[key] <= 0:
+                del counts[key]
+
+    def getKey(self, render: Render):
+        # Set once, a render given back by pushFront keeps its place
+        if render.schedulingKey is None:
+            queuedTime = render.queuedTime if render.queuedTime is not None else time.monotonic()
+            render.schedulingKey = queuedTime + self.costWeight * (render.estimatedSeconds or 0)
+        return render.schedulingKey
+
+    def push(self, render: Render):
+        # Makes a render available for the workers
+        guildId = render.get_guild_id()
+        if guildId not in self.guildQueues:
+            self.guildQueues[guildId] = []
+            self.round.add(guildId)
+        heapq.heappush(self.guildQueues[guildId], (self.getKey(render), next(self.sequence), render))
+
+    def pushFront(self, render: Render):
+        # Gives back a render that couldn't be started, without losing its turn
+        self.push(render)
+        self.round.add(render.get_guild_id())
+
+    def discard(self, render: Render):
+        guildId = render.get_guild_id()
+        guildQueue = self.guildQueues.get(guildId)
+        if guildQueue is None:
+            return
+        for index, entry in enumerate(guildQueue):
+            if entry[2] is render:
+                guildQueue.pop(index)
+                heapq.heapify(guildQueue)
+                break
+        if not guildQueue:
+            del self.guildQueues[guildId]
+            self.round.discard(guildId)
+
+    def next(self):
+        if not self.guildQueues:
+            return None
+        if not self.round:
+            self.round = set(self.guildQueues)
+        guildId = min(self.round, key=lambda guildId: self.guildQueues[guildId][0])
+        self.round.discard(guildId)
+        guildQueue = self.guildQueues[guildId]
+        _, _, render = heapq.heappop(guildQueue)
+        if not guildQueue:
+            del self.guildQueues[guildId]
+        return render
+
+    def getOrder(self):
+        # The waiting renders in the order next() would return them, if nothing else was queued
+        guildQueues = {guildId: deque(sorted(guildQueue)) for guildId, guildQueue in self.guildQueues.items()}
+        currentRound = set(self.round)
+        order = []
+        while guildQueues:
+            if not currentRound:
+                currentRound = set(guildQueues)
+            guildId = min(currentRound, key=lambda guildId: guildQueues[guildId][0])
+            currentRound.discard(guildId)
+            order.append(guildQueues[guildId].popleft()[2])
+            if not guildQueues[guildId]:
+                del guildQueues[guildId]
+        return order
+
+    def getBacklogSeconds(self):
+        # Expected render time of every waiting render together
+        return sum(
+            render.estimatedSeconds or 0
+            for guildQueue in self.guildQueues.values()
+            for _, _, render in guildQueue
+        )
+
+    def getGuildCount(self, guildId: int):
+        return self.guildCounts[guildId]
+
+    def getUserCount(self, userId: int):
+        return self.userCounts[userId]
+
+    def __len__(self):
+        return sum(len(guildQueue) for guildQueue in self.guildQueues.values())
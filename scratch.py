@@ -0,0 +1,103 @@
+import asyncio
+import os
+import re
+import shutil
+from datetime import datetime
+
+# Rough size of a rendered video per message, reserved before it's rendered
+BYTES_PER_MESSAGE = 500000
+# Videos and evidence images (named after their attachment id) of the versions that wrote them
+# to the working directory, before the job store existed
+LEGACY_FILES = re.compile(r"(\d{4}_\d{2}_\d{2}-\d{2}_\d{2}_\d{2}_[AP]M\.mp4|\d{17,20}\.png)")
+
+
+class ScratchSpace:
+    """
+    Gives every render its own directory, named after its id, for its video and the smaller
+    copy made from it, so renders can't overwrite each other's files and nothing is left
+    behind once the directory is removed. The directory can be on a tmpfs such as /dev/shm,
+    to keep the videos in memory.
+    Renders reserve the space they are expected to need before they are queued; once quota
+    bytes are reserved, new renders wait for others to finish.
+    """
+
+    def __init__(self, directory: str = "scratch", quota: int = 5000000000):
+        self.directory = os.path.abspath(directory)
+        self.quota = quota
+        self.reserved = {}  # job id -> bytes
+        self.freed = asyncio.Event()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def getPath(self, jobId: int):
+        return os.path.join(self.directory, str(jobId))
+
+    def create(self, jobId: int):
+        # Returns the render's output file, named after the time since that's what users download
+        os.makedirs(self.getPath(jobId), exist_ok=True)
+        filename = datetime.now().strftime("%Y_%m_%d-%H_%M_%S")
+        return os.path.join(self.getPath(jobId), f"{filename}.mp4")
+
+    def estimate(self, messageCount: int):
+        return messageCount * BYTES_PER_MESSAGE
+
+    def getReserved(self):
+        return sum(self.reserved.values())
+
+    async def reserve(self, jobId: int, size: int, timeout: float):
+        # Returns False if the space couldn't be reserved within timeout seconds
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        # A render bigger than the quota still goes through when it's alone
+        while self.reserved and self.getReserved() + size > self.quota:
+            self.freed.clear()
+            try:
+                await asyncio.wait_for(self.freed.wait(), timeout=deadline - loop.time())
+            except asyncio.TimeoutError:
+                return False
+        self.reserved[jobId] = size
+        return True
+
+    def adopt(self, jobId: int):
+        # Accounts for the directory of a render restored after a restart
+        self.reserved[jobId] = self.measure(jobId)
+
+    def measure(self, jobId: int):
+        size = 0
+        for root, _, filenames in os.walk(self.getPath(jobId)):
+            for filename in filenames:
+                try:
+                    size += os.path.getsize(os.path.join(root, filename))
+                except OSError:
+                    pass
+        return size
+
+    def update(self, jobId: int):
+        # The video is done, its real size replaces the estimate
+        if jobId in self.reserved:
+            self.reserved[jobId] = self.measure(jobId)
+            self.freed.set()
+
+    def release(self, jobId: int):
+        shutil.rmtree(self.getPath(jobId), ignore_errors=True)
+        if self.reserved.pop(jobId, None) is not None:
+            self.freed.set()
+
+    def sweep(self, keep: set, legacy: bool = False):
+        # Removes what renders that are gone left behind, keep holds the paths still in use.
+        # The working directory is only swept with legacy, on the first start after a version
+        # that wrote its files there
+        removed = 0
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if path not in keep:
+                shutil.rmtree(path, ignore_errors=True)
+                removed += 1
+        for name in os.listdir(".") if legacy else []:
+            if LEGACY_FILES.fullmatch(name) and os.path.abspath(name) not in keep:
+                try:
+                    os.remove(name)
+                    removed += 1
+                except OSError as exception:
+                    print(f"Error: {exception}")
+        if removed:
+            print(f"Removed {removed} file(s) left by earlier runs")
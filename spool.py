@@ -0,0 +1,470 @@
+"""
+Split deployment: the bot writes renders to a spool directory shared with render nodes, which
+claim them, render them and write the videos back.
+
+A job is a directory, named after the render's id, that moves between three folders:
+    queued/<id>             written by the bot: job.json, the evidence images and, for jobs
+                            that only have to be made smaller, the video as input.mp4
+    leased/<id>.<token>     claimed by a node with an atomic rename; the node keeps touching
+                            its lease file while it works on it
+    done/<id>               the node wrote result/ (result.json, output.mp4, the smaller copy)
+The bot puts jobs whose lease wasn't renewed for leaseTime seconds back in queued/, so the
+jobs of a dead node are rendered by another one.
+
+Start a render node with:
+    python spool.py <spool directory> --workers 2
+"""
+import argparse
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "objection_engine"))
+
+from comment import Comment
+from render import Render, State
+from rendercache import linkFile
+from worker import RenderPool
+
+INPUT_VIDEO = "input.mp4"
+OUTPUT_VIDEO = "output.mp4"
+
+
+class Spool:
+    def __init__(self, directory: str):
+        self.directory = os.path.abspath(directory)
+        for folder in ("queued", "leased", "done"):
+            os.makedirs(self.getPath(folder), exist_ok=True)
+
+    def getPath(self, *names):
+        return os.path.join(self.directory, *names)
+
+    def listJobs(self, folder: str):
+        # Names starting with a dot are still being written
+        return sorted(name for name in os.listdir(self.getPath(folder)) if not name.startswith("."))
+
+    def remove(self, path: str):
+        shutil.rmtree(path, ignore_errors=True)
+
+
+class SpoolPool:
+    """
+    Used by the bot instead of worker.RenderPool: renders are written to the spool instead of
+    being handed to local processes. At most capacity renders are in the spool at once, the
+    others wait in the bot's own queue so its scheduling still applies.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        capacity: int = 8,
+        onStateChange=None,
+        leaseTime: float = 60,
+        maxAttempts: int = 3,
+        pollInterval: float = 1.0,
+    ):
+        self.spool = Spool(directory)
+        self.capacity = max(1, capacity)
+        # Optional callback(render), called from the monitor thread after every state change
+        self.onStateChange = onStateChange
+        self.leaseTime = leaseTime
+        self.maxAttempts = maxAttempts
+        self.pollInterval = pollInterval
+        self.renders = {}  # id -> render in the spool
+        self.attempts = {}  # id -> number of leases that expired
+        self.lock = threading.Lock()
+        # Evidence and videos are copied out of the event loop
+        self.writer = ThreadPoolExecutor(max_workers=2, thread_name_prefix="SpoolWriter")
+        self.running = False
+        # Jobs of renders the bot doesn't know are only removed once it restored the renders of
+        # its previous run, which take back their jobs
+        self.restored = False
+
+    def start(self):
+        self.running = True
+        self.monitorThread = threading.Thread(target=self.monitor, name="SpoolMonitor", daemon=True)
+        self.monitorThread.start()
+
+    def stop(self):
+        self.running = False
+        self.writer.shutdown(wait=True)
+
+    def endRestore(self):
+        # Called once the renders of the previous run are submitted again
+        self.restored = True
+
+    def hasIdleWorker(self):
+        with self.lock:
+            return len(self.renders) < self.capacity
+
+    def submit(self, render: Render):
+        # Returns False if the spool is full, so the render stays QUEUED
+        with self.lock:
+            if len(self.renders) >= self.capacity:
+                return False
+            render.setState(State.INPROGRESS)
+            self.renders[render.get_id()] = render
+        self.notify(render)
+        self.writer.submit(self.write, render)
+        return True
+
+    def cancel(self, render: Render):
+        # Jobs already claimed by a node are finished there and their result thrown away
+        with self.lock:
+            if self.renders.get(render.get_id()) is not render:
+                return False
+            del self.renders[render.get_id()]
+            self.attempts.pop(render.get_id(), None)
+        self.writer.submit(self.discard, render.get_id())
+        return True
+
+    def write(self, render: Render):
+        jobId = render.get_id()
+        with self.lock:
+            if jobId not in self.renders:
+                # Cancelled before it was written
+                return
+        try:
+            if self.findJob(render):
+                # Written before the bot restarted, it's collected like the others
+                return
+            self.discard(jobId)
+            staging = self.spool.getPath("queued", f".{jobId}")
+            os.makedirs(staging)
+            comments = []
+            for comment in render.getMessages():
+                evidence = None
+                if comment.evidence_path is not None:
+                    evidence = os.path.basename(comment.evidence_path)
+                    if not os.path.exists(os.path.join(staging, evidence)):
+                        linkFile(comment.evidence_path, os.path.join(staging, evidence))
+                comments.append(
+                    [comment.user_id, comment.user_name, comment.text_content, evidence]
+                )
+            if render.transcodeOnly:
+                linkFile(render.getOutputFilename(), os.path.join(staging, INPUT_VIDEO))
+            with open(os.path.join(staging, "job.json"), "w") as file:
+                json.dump(
+                    {
+                        "id": jobId,
+                        "comments": comments,
+                        "music_code": render.music_code,
+                        "resolution_scale": render.resolutionScale,
+                        "size_limit": render.getSizeLimit(),
+                        "render_video": not render.transcodeOnly,
+                    },
+                    file,
+                )
+            os.rename(staging, self.spool.getPath("queued", str(jobId)))
+        except Exception as exception:
+            print(f"Error: {exception}")
+            self.finish(jobId, State.FAILED)
+
+    def findJob(self, render: Render):
+        # Whether the spool already holds a job for this render, waiting, in the hands of a node
+        # or done, that does the same work
+        jobId = str(render.get_id())
+        paths = [self.spool.getPath("queued", jobId), self.spool.getPath("done", jobId)]
+        paths += [
+            self.spool.getPath("leased", name)
+            for name in self.spool.listJobs("leased")
+            if name.split(".", 1)[0] == jobId
+        ]
+        for path in paths:
+            try:
+                with open(os.path.join(path, "job.json")) as file:
+                    job = json.load(file)
+            except (OSError, ValueError):
+                continue
+            if job["render_video"] == (not render.transcodeOnly):
+                return True
+        return False
+
+    def discard(self, jobId: int):
+        # Leftovers of an earlier attempt, for example before the bot restarted
+        self.spool.remove(self.spool.getPath("queued", f".{jobId}"))
+        self.spool.remove(self.spool.getPath("queued", str(jobId)))
+        self.spool.remove(self.spool.getPath("done", str(jobId)))
+        for name in self.spool.listJobs("leased"):
+            if name.split(".", 1)[0] == str(jobId):
+                self.spool.remove(self.spool.getPath("leased", name))
+
+    def notify(self, render: Render):
+        if self.onStateChange is not None:
+            try:
+                self.onStateChange(render)
+            except Exception as exception:
+                print(f"Error: {exception}")
+
+    def finish(self, jobId: int, state: State):
+        with self.lock:
+            render = self.renders.pop(jobId, None)
+            self.attempts.pop(jobId, None)
+        if render is not None:
+            render.setState(state)
+            self.notify(render)
+
+    def monitor(self):
+        while self.running:
+            try:
+                for name in self.spool.listJobs("done"):
+                    self.collect(name)
+                for name in self.spool.listJobs("leased"):
+                    self.checkLease(name)
+            except Exception as exception:
+                print(f"Error: {exception}")
+            time.sleep(self.pollInterval)
+
+    def collect(self, name: str):
+        path = self.spool.getPath("done", name)
+        with self.lock:
+            render = self.renders.get(int(name))
+        if render is None:
+            # Not ours anymore, unless a render that is still to be restored takes it back
+            if self.restored:
+                self.spool.remove(path)
+            return
+        state = State.FAILED
+        try:
+            with open(os.path.join(path, "result", "result.json")) as file:
+                result = json.load(file)
+            if result["error"] is not None:
+                print(f"Error: {result['error']}")
+            if result["state"] == State.RENDERED.name:
+                if not render.transcodeOnly:
+                    shutil.move(os.path.join(path, "result", OUTPUT_VIDEO), render.getOutputFilename())
+                render.fittedFilename = None
+                if result["fitted"] is not None:
+                    render.fittedFilename = (
+                        os.path.splitext(render.getOutputFilename())[0]
+                        + "-fit"
+                        + os.path.splitext(result["fitted"])[1]
+                    )
+                    shutil.move(os.path.join(path, "result", result["fitted"]), render.fittedFilename)
+                render.fitChecked = True
+                state = State.RENDERED
+        except Exception as exception:
+            print(f"Error: {exception}")
+        self.spool.remove(path)
+        self.finish(render.get_id(), state)
+
+    def checkLease(self, name: str):
+        path = self.spool.getPath("leased", name)
+        try:
+            leaseFile = os.path.join(path, "lease")
+            # A node that died right after claiming the job didn't write its lease yet
+            renewed = os.path.getmtime(leaseFile) if os.path.exists(leaseFile) else os.stat(path).st_ctime
+        except FileNotFoundError:
+            return
+        if time.time() - renewed < self.leaseTime:
+            return
+        jobId = int(name.split(".", 1)[0])
+        with self.lock:
+            known = jobId in self.renders
+            if known:
+                attempts = self.attempts[jobId] = self.attempts.get(jobId, 0) + 1
+        if not known:
+            if self.restored:
+                self.spool.remove(path)
+            return
+        print(f"Error: the lease of render {jobId} expired ({name})")
+        if attempts >= self.maxAttempts:
+            self.spool.remove(path)
+            self.finish(jobId, State.FAILED)
+            return
+        try:
+            self.spool.remove(os.path.join(path, "result"))
+            os.remove(leaseFile)
+        except FileNotFoundError:
+            pass
+        try:
+            os.rename(path, self.spool.getPath("queued", str(jobId)))
+        except OSError as exception:
+            print(f"Error: {exception}")
+
+
+class SpoolJob:
+    # A job claimed by a render node, with what worker.RenderPool needs from a render
+    def __init__(self, path: str, job: dict, outputFilename: str):
+        self.path = path
+        self.jobId = job["id"]
+        self.messages = [
+            Comment(
+                user_id=userId,
+                user_name=userName,
+                text_content=textContent,
+                evidence_path=os.path.join(path, evidence) if evidence is not None else None,
+            )
+            for userId, userName, textContent, evidence in job["comments"]
+        ]
+        self.outputFilename = outputFilename
+        self.music_code = job["music_code"]
+        self.resolutionScale = job["resolution_scale"]
+        self.sizeLimit = job["size_limit"]
+        self.transcodeOnly = not job["render_video"]
+        self.state = State.QUEUED
+        self.fittedFilename = None
+        self.fitChecked = False
+
+    def get_id(self):
+        return self.jobId
+
+    def getMessages(self):
+        return self.messages
+
+    def getOutputFilename(self):
+        return self.outputFilename
+
+    def getSizeLimit(self):
+        return self.sizeLimit
+
+    def getState(self):
+        return self.state
+
+    def setState(self, state: State):
+        self.state = state
+
+
+class SpoolNode:
+    """
+    A render node: claims jobs from the spool while it has idle workers, renders them with a
+    local worker.RenderPool and writes the results back.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        workers: int = 1,
+        codec: str = "h264",
+        pollInterval: float = 1.0,
+        renderFunction=None,
+        maxJobs: int = 0,
+        maxRss: int = 0,
+        memoryBudget: int = 0,
+        assetDirectory: str = None,
+    ):
+        self.spool = Spool(directory)
+        self.pollInterval = pollInterval
+        self.name = f"{socket.gethostname()}-{os.getpid()}"
+        # Videos are rendered on the local disk and only copied to the spool once done
+        self.scratch = tempfile.mkdtemp(prefix="spool-")
+        self.jobs = {}  # id -> SpoolJob being rendered
+        self.lock = threading.Lock()
+        self.pool = RenderPool(
+            workers,
+            onStateChange=self.onStateChange,
+            codec=codec,
+            renderFunction=renderFunction,
+            maxJobs=maxJobs,
+            maxRss=maxRss,
+            memoryBudget=memoryBudget,
+            assetDirectory=assetDirectory,
+        )
+
+    def run(self):
+        self.pool.start()
+        print(f"Render node {self.name} is consuming {self.spool.directory}")
+        try:
+            while True:
+                self.renewLeases()
+                while self.pool.hasIdleWorker():
+                    job = self.claim()
+                    if job is None:
+                        break
+                    with self.lock:
+                        self.jobs[job.get_id()] = job
+                    self.pool.submit(job)
+                time.sleep(self.pollInterval)
+        finally:
+            self.pool.stop()
+            shutil.rmtree(self.scratch, ignore_errors=True)
+
+    def claim(self):
+        for name in self.spool.listJobs("queued"):
+            path = self.spool.getPath("leased", f"{name}.{self.name}-{uuid.uuid4().hex[:8]}")
+            try:
+                os.rename(self.spool.getPath("queued", name), path)
+            except OSError:
+                # Another node got it first
+                continue
+            try:
+                open(os.path.join(path, "lease"), "w").close()
+                with open(os.path.join(path, "job.json")) as file:
+                    job = SpoolJob(path, json.load(file), os.path.join(self.scratch, f"{name}.mp4"))
+                if job.transcodeOnly:
+                    shutil.copyfile(os.path.join(path, INPUT_VIDEO), job.getOutputFilename())
+                return job
+            except Exception as exception:
+                print(f"Error: {exception}")
+                self.writeResult(path, State.FAILED, str(exception), None, None)
+        return None
+
+    def renewLeases(self):
+        with self.lock:
+            jobs = list(self.jobs.values())
+        for job in jobs:
+            try:
+                os.utime(os.path.join(job.path, "lease"))
+            except FileNotFoundError:
+                # Expired and taken back by the bot, the result will be thrown away
+                pass
+
+    def onStateChange(self, job: SpoolJob):
+        # Called from the pool's monitor thread
+        state = job.getState()
+        if state not in (State.RENDERED, State.FAILED):
+            return
+        with self.lock:
+            self.jobs.pop(job.get_id(), None)
+        error = None if state == State.RENDERED else "Render failed"
+        self.writeResult(job.path, state, error, job.getOutputFilename(), job.fittedFilename)
+        for filename in (job.getOutputFilename(), job.fittedFilename):
+            if filename is not None and os.path.exists(filename):
+                os.remove(filename)
+
+    def writeResult(self, path: str, state: State, error, outputFilename, fittedFilename):
+        resultPath = os.path.join(path, "result")
+        try:
+            # mkdir rather than makedirs, the job folder is gone if the lease was lost
+            os.mkdir(resultPath)
+            fitted = None
+            if state == State.RENDERED:
+                shutil.copyfile(outputFilename, os.path.join(resultPath, OUTPUT_VIDEO))
+                if fittedFilename is not None:
+                    fitted = os.path.basename(fittedFilename)
+                    shutil.copyfile(fittedFilename, os.path.join(resultPath, fitted))
+            with open(os.path.join(resultPath, "result.json"), "w") as file:
+                json.dump({"state": state.name, "error": error, "fitted": fitted}, file)
+            os.rename(path, self.spool.getPath("done", os.path.basename(path).split(".", 1)[0]))
+        except OSError as exception:
+            print(f"Error: could not hand back {os.path.basename(path)}: {exception}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render node consuming a spool directory")
+    parser.add_argument("directory", help="spool directory shared with the bot")
+    parser.add_argument("--workers", type=int, default=1, help="renders at the same time")
+    parser.add_argument("--codec", default="h264", help="codec used to make videos smaller, h264 or vp9")
+    parser.add_argument("--poll-interval", type=float, default=1.0, help="seconds between spool checks and lease renewals")
+    parser.add_argument("--max-jobs", type=int, default=50, help="renders before a worker is restarted, 0 for no limit")
+    parser.add_argument("--max-rss", type=int, default=1500, help="MB a worker can use before it's restarted, 0 for no limit")
+    parser.add_argument("--memory-budget", type=int, default=0, help="MB all workers can use together, 0 for no limit")
+    parser.add_argument("--asset-dir", default="asset_cache", help="decoded engine assets shared by the workers, best on a tmpfs such as /dev/shm")
+    arguments = parser.parse_args()
+    SpoolNode(
+        arguments.directory,
+        workers=arguments.workers,
+        codec=arguments.codec,
+        pollInterval=arguments.poll_interval,
+        maxJobs=arguments.max_jobs,
+        maxRss=arguments.max_rss * 1000000,
+        memoryBudget=arguments.memory_budget * 1000000,
+        assetDirectory=arguments.asset_dir,
+    ).run()
@@ -0,0 +1,90 @@
+import os
+import re
+import subprocess
+import tempfile
+
+AUDIO_BITRATE = 64000
+# Below this the video isn't worth watching anymore, it's uploaded somewhere else instead
+MIN_VIDEO_BITRATE = 100000
+# Room left for the container overhead
+SIZE_MARGIN = 0.95
+CODECS = {
+    "h264": {
+        "extension": "mp4",
+        "video": ["-c:v", "libx264", "-preset", "medium", "-pix_fmt", "yuv420p"],
+        "audio": ["-c:a", "aac", "-movflags", "+faststart"],
+    },
+    "vp9": {
+        "extension": "webm",
+        "video": ["-c:v", "libvpx-vp9", "-row-mt", "1", "-deadline", "good"],
+        "audio": ["-c:a", "libopus"],
+    },
+}
+
+
+def getFfmpeg():
+    # The engine renders through moviepy, which ships its own ffmpeg binary
+    try:
+        import imageio_ffmpeg
+
+        return imageio_ffmpeg.get_ffmpeg_exe()
+    except Exception:
+        return "ffmpeg"
+
+
+def getDuration(filename: str):
+    result = subprocess.run(
+        [getFfmpeg(), "-hide_banner", "-i", filename],
+        capture_output=True,
+        text=True,
+    )
+    match = re.search(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)", result.stderr)
+    if match is None:
+        raise Exception(f"Unable to get the duration of {filename}")
+    hours, minutes, seconds = match.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+def getVideoBitrate(duration: float, sizeLimit: int):
+    return int(sizeLimit * 8 * SIZE_MARGIN / duration) - AUDIO_BITRATE
+
+
+def encode(source: str, output: str, videoBitrate: int, codec: str):
+    settings = CODECS[codec]
+    video = settings["video"] + ["-b:v", str(videoBitrate)]
+    with tempfile.TemporaryDirectory() as directory:
+        passLog = os.path.join(directory, "pass")
+        # The first pass only analyses the video, so the second one can spread the bitrate where it's needed
+        subprocess.run(
+            [getFfmpeg(), "-y", "-loglevel", "error", "-i", source, *video,
+             "-pass", "1", "-passlogfile", passLog, "-an", "-f", settings["extension"], os.devnull],
+            check=True,
+        )
+        subprocess.run(
+            [getFfmpeg(), "-y", "-loglevel", "error", "-i", source, *video,
+             "-pass", "2", "-passlogfile", passLog, *settings["audio"], "-b:a", str(AUDIO_BITRATE), output],
+            check=True,
+        )
+
+
+def fitToSize(filename: str, sizeLimit: int, codec: str = "h264"):
+    """
+    Re-encodes a video so it's smaller than sizeLimit bytes, with a two-pass encode at the
+    bitrate its duration allows. Returns the new file, or None if it can't fit at a
+    watchable quality.
+    """
+    if codec not in CODECS:
+        raise Exception(f"Unknown codec '{codec}'")
+    videoBitrate = getVideoBitrate(getDuration(filename), sizeLimit)
+    output = f"{os.path.splitext(filename)[0]}-fit.{CODECS[codec]['extension']}"
+    # The encoder doesn't always hit the target, a second try is done a bit lower
+    for _ in range(2):
+        if videoBitrate < MIN_VIDEO_BITRATE:
+            break
+        encode(filename, output, videoBitrate, codec)
+        if os.path.getsize(output) < sizeLimit:
+            return output
+        videoBitrate = int(videoBitrate * 0.85)
+    if os.path.exists(output):
+        os.remove(output)
+    return None
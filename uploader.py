@@ -0,0 +1,100 @@
+import asyncio
+import os
+import random
+from abc import ABC, abstractmethod
+from typing import Optional
+
+import aiohttp
+import discord
+
+# Errors worth trying again, anything else (like a file being too big) will fail the same way
+RETRYABLE_ERRORS = (
+    aiohttp.ClientConnectionError,
+    aiohttp.ClientPayloadError,
+    asyncio.TimeoutError,
+    discord.DiscordServerError,
+    ConnectionError,
+)
+
+
+async def retry(upload, attempts: int = 3, delay: float = 2.0):
+    """
+    Awaits upload() until it succeeds, up to attempts times, waiting delay seconds before the
+    first retry and doubling it (plus some jitter) every time.
+    """
+    for attempt in range(1, attempts + 1):
+        try:
+            return await upload()
+        except RETRYABLE_ERRORS as exception:
+            if attempt == attempts:
+                raise
+            wait = delay * 2 ** (attempt - 1) * random.uniform(1, 1.5)
+            print(f"Error: {exception}, retrying in {round(wait, 1)} seconds")
+            await asyncio.sleep(wait)
+
+
+class ExternalUploader(ABC):
+    """
+    Uploads videos too big for Discord somewhere else and returns a link to them.
+    The file is streamed from disk, it's never loaded in memory at once.
+    """
+
+    # Shown to the user next to the link
+    notice = ""
+
+    def __init__(self, url: str, timeout: int = 300):
+        self.url = url
+        self.timeout = timeout
+        self.session: Optional[aiohttp.ClientSession] = None
+
+    def getSession(self):
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+        return self.session
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+    @abstractmethod
+    async def upload(self, filename: str):
+        # Returns the link to the uploaded file
+        pass
+
+
+class UguuUploader(ExternalUploader):
+    notice = "_This video will be deleted in 48 hours_"
+
+    def __init__(self, url: str = "https://uguu.se/upload.php?output=text", timeout: int = 300):
+        super().__init__(url, timeout)
+
+    async def upload(self, filename: str):
+        with open(filename, "rb") as videoFile:
+            data = aiohttp.FormData()
+            data.add_field(
+                "files[]",
+                videoFile,
+                filename=os.path.basename(filename),
+                content_type="video/mp4",
+            )
+            async with self.getSession().post(self.url, data=data) as response:
+                response.raise_for_status()
+                url = (await response.text()).strip()
+        if not url.startswith("http"):
+            raise Exception(f"Unexpected answer from the external server: {url[:100]}")
+        return url
+
+
+EXTERNAL_UPLOADERS = {
+    "uguu": UguuUploader,
+}
+
+
+def createExternalUploader(name: str = "uguu", url: Optional[str] = None, timeout: int = 300):
+    if name not in EXTERNAL_UPLOADERS:
+        raise Exception(f"Unknown external uploader '{name}'")
+    if url:
+        return EXTERNAL_UPLOADERS[name](url=url, timeout=timeout)
+    return EXTERNAL_UPLOADERS[name](timeout=timeout)
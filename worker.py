@@ -0,0 +1,502 @@
+import json
+import multiprocessing
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from multiprocessing.connection import wait
+
+from assets import AssetStore
+from comment import Comment
+from metrics import WORKER_MEMORY_BYTES, WORKER_RECYCLES_TOTAL
+from render import Render, State
+from transcode import fitToSize
+
+
+# Sent by a worker once it's warmed up, instead of a result
+READY = "ready"
+# The engine's music, written by the render workers so the bot never has to import the engine.
+# Next to this file, like the engine submodule, whatever the working directory is
+REPOSITORY = os.path.dirname(os.path.abspath(__file__))
+MUSIC_CACHE = os.path.join(REPOSITORY, "music_cache.json")
+LIST_MUSIC = (
+    "import json; "
+    "from objection_engine import get_all_music_available; "
+    "print(json.dumps(get_all_music_available()))"
+)
+# Used by processes that can't list the music, it's enough to define the bot's commands
+DEFAULT_MUSIC = ["pwr"]
+
+
+def saveMusicList(music: list):
+    with open(f"{MUSIC_CACHE}.part", "w") as file:
+        json.dump(music, file)
+    os.replace(f"{MUSIC_CACHE}.part", MUSIC_CACHE)
+
+
+def loadMusicList(listMissing: bool = True):
+    # Lists the music in a separate process on the very first start, when nothing is cached yet.
+    # With listMissing=False nothing is started and DEFAULT_MUSIC is used instead
+    try:
+        with open(MUSIC_CACHE) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        pass
+    if not listMissing:
+        return list(DEFAULT_MUSIC)
+    # The engine is found the same way as in this process, and in the submodule
+    path = [os.path.join(REPOSITORY, "objection_engine")] + [os.path.abspath(entry) for entry in sys.path if entry]
+    output = subprocess.run(
+        [sys.executable, "-c", LIST_MUSIC],
+        check=True,
+        capture_output=True,
+        text=True,
+        env=dict(os.environ, PYTHONPATH=os.pathsep.join(path)),
+    ).stdout
+    music = json.loads(output.splitlines()[-1])
+    saveMusicList(music)
+    return music
+
+
+def toEngineComments(comments):
+    from objection_engine.beans.comment import Comment as EngineComment
+
+    return [
+        EngineComment(
+            user_id=comment.user_id,
+            user_name=comment.user_name,
+            text_content=comment.text_content,
+            evidence_path=comment.evidence_path,
+        )
+        for comment in comments
+    ]
+
+
+def warmUp(renderFunction, engine: bool):
+    # A throwaway render loads the fonts, sprites and sounds the first real render would wait for
+    comments = [Comment(user_id="0", user_name="Phoenix", text_content="Hold it!")]
+    if engine:
+        comments = toEngineComments(comments)
+    directory = tempfile.mkdtemp(prefix="warmup-")
+    try:
+        renderFunction(
+            comments, os.path.join(directory, "warmup.mp4"), music_code="pwr", resolution_scale=1
+        )
+    except Exception as exception:
+        traceback.print_exc()
+        print(f"Error: {exception}")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def getMemoryUsage():
+    # Resident memory of this process and its peak, in bytes, (None, None) without /proc
+    try:
+        with open("/proc/self/status") as file:
+            fields = dict(line.split(":", 1) for line in file if ":" in line)
+        return int(fields["VmRSS"].split()[0]) * 1024, int(fields["VmHWM"].split()[0]) * 1024
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def renderWorker(jobReader, resultWriter, codec, renderFunction, maxJobs, maxRss, warm, assetDirectory):
+    # The engine is imported here so that it is only loaded by the render processes
+    start = time.monotonic()
+    if hasattr(os, "setpgrp"):
+        # Its own process group, killing the worker also kills the ffmpeg processes it started
+        os.setpgrp()
+    engine = renderFunction is None
+    assetStore = None
+    if engine:
+        if assetDirectory:
+            assetStore = AssetStore(assetDirectory)
+            assetStore.install()
+        from objection_engine import get_all_music_available
+        from objection_engine.renderer import render_comment_list
+
+        renderFunction = render_comment_list
+        try:
+            saveMusicList(get_all_music_available())
+        except Exception as exception:
+            print(f"Error: {exception}")
+    if warm:
+        warmUp(renderFunction, engine)
+        if assetStore is not None:
+            assetStore.checkUsed()
+    resultWriter.send((READY, time.monotonic() - start))
+
+    jobs = 0
+    while True:
+        try:
+            job = jobReader.recv()
+        except EOFError:
+            # The bot process went away
+            break
+        if job is None:
+            break
+        jobId, comments, outputFilename, musicCode, resolutionScale, sizeLimit, renderVideo = job
+        if engine:
+            comments = toEngineComments(comments)
+        rssBefore, _ = getMemoryUsage()
+        state, error, fittedFilename = State.RENDERED, None, None
+        try:
+            if renderVideo:
+                renderFunction(
+                    comments,
+                    outputFilename,
+                    music_code=musicCode,
+                    resolution_scale=resolutionScale,
+                )
+        except Exception as exception:
+            traceback.print_exc()
+            state, error = State.FAILED, str(exception)
+        if assetStore is not None and renderVideo and state == State.RENDERED:
+            assetStore.checkUsed()
+        if state == State.RENDERED:
+            try:
+                # Too big for the server, it's re-encoded here rather than uploaded somewhere else
+                if sizeLimit is not None and os.path.getsize(outputFilename) >= sizeLimit:
+                    fittedFilename = fitToSize(outputFilename, sizeLimit, codec)
+            except Exception as exception:
+                traceback.print_exc()
+                print(f"Error: {exception}")
+
+        # Frames and buffers the engine doesn't give back pile up, the worker is replaced
+        # by a fresh one once it rendered too much or grew too big
+        jobs += 1
+        rssAfter, peakRss = getMemoryUsage()
+        retiring = None
+        if maxJobs and jobs >= maxJobs:
+            retiring = "jobs"
+            print(f"{multiprocessing.current_process().name} is restarting after {jobs} renders")
+        elif maxRss and rssAfter is not None and rssAfter >= maxRss:
+            retiring = "memory"
+            print(
+                f"{multiprocessing.current_process().name} is restarting, it uses {rssAfter // 1000000} MB"
+            )
+        resultWriter.send(
+            (jobId, state, error, fittedFilename, (rssBefore, rssAfter, peakRss, retiring))
+        )
+        if retiring is not None:
+            break
+
+
+class RenderWorker:
+    def __init__(
+        self,
+        context,
+        index: int,
+        codec: str,
+        renderFunction=None,
+        maxJobs: int = 0,
+        maxRss: int = 0,
+        warm: bool = True,
+        assetDirectory: str = None,
+    ):
+        self.index = index
+        self.render = None
+        # Set once the worker loaded the engine and did its warm up render
+        self.ready = False
+        # Killed on purpose to cancel its render
+        self.cancelled = False
+        # Why the worker is exiting on its own after its last render, "jobs" or "memory"
+        self.retiring = None
+        jobReader, self.jobWriter = context.Pipe(duplex=False)
+        self.resultReader, resultWriter = context.Pipe(duplex=False)
+        self.process = context.Process(
+            target=renderWorker,
+            args=(jobReader, resultWriter, codec, renderFunction, maxJobs, maxRss, warm, assetDirectory),
+            name=f"RenderWorker-{index}",
+            daemon=True,
+        )
+        self.process.start()
+        # Close the child's ends on our side, so a dead worker shows up as EOF instead of a hang
+        jobReader.close()
+        resultWriter.close()
+
+    def isIdle(self):
+        # Cancelled and retiring workers are exiting, they're replaced by new ones
+        return (
+            self.ready and self.render is None and not self.cancelled and self.retiring is None
+        )
+
+    def assign(self, render: Render):
+        self.render = render
+        self.jobWriter.send(
+            (
+                render.get_id(),
+                render.getMessages(),
+                render.getOutputFilename(),
+                render.music_code,
+                render.resolutionScale,
+                render.getSizeLimit(),
+                not render.transcodeOnly,
+            )
+        )
+
+    def stop(self):
+        try:
+            self.jobWriter.send(None)
+        except Exception:
+            pass
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.kill()
+        self.jobWriter.close()
+        self.resultReader.close()
+
+    def kill(self):
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except (AttributeError, OSError):
+            # No process group (not on POSIX, or it wasn't created yet), only the worker is killed
+            self.process.kill()
+
+
+class RenderPool:
+    """
+    Keeps a fixed number of render processes alive and hands QUEUED renders to them.
+    State changes are applied to the Render objects from the monitor thread; if a worker
+    dies (crash, OOM killer...) only the render it was working on is marked as FAILED
+    and a new worker takes its place.
+    New workers do a small render to warm up (unless warm is False) and only take renders
+    once they're done with it.
+    Workers restart after maxJobs renders or once they use more than maxRss bytes. With a
+    memoryBudget, renders only start while the workers rendering are expected to fit in it,
+    from the peak memory workers report.
+    """
+
+    def __init__(
+        self,
+        size: int,
+        onStateChange=None,
+        codec: str = "h264",
+        renderFunction=None,
+        maxJobs: int = 0,
+        maxRss: int = 0,
+        memoryBudget: int = 0,
+        renderMemory: int = 800000000,
+        onWorkerReady=None,
+        warm: bool = True,
+        assetDirectory: str = None,
+    ):
+        self.context = multiprocessing.get_context("spawn")
+        self.size = max(1, size)
+        # Replaces the engine's render_comment_list, it has to be picklable (used by benchmark.py)
+        self.renderFunction = renderFunction
+        # Used to re-encode videos too big for their server
+        self.codec = codec
+        # Optional callback(render), called from the monitor thread after every state change
+        self.onStateChange = onStateChange
+        # Optional callback(), called from the monitor thread when a worker is ready to render
+        self.onWorkerReady = onWorkerReady
+        self.warm = warm
+        # Engine assets are decoded once into this directory and shared by the workers, see assets.AssetStore
+        self.assetDirectory = assetDirectory
+        self.maxJobs = maxJobs
+        self.maxRss = maxRss
+        self.memoryBudget = memoryBudget
+        # Memory a worker is expected to need while rendering, follows the peaks they report
+        self.renderMemory = renderMemory
+        self.workers = []
+        self.lock = threading.Lock()
+        self.running = False
+        self.nextIndex = 0
+
+    def start(self):
+        with self.lock:
+            for _ in range(self.size):
+                self.workers.append(self.spawnWorker())
+        self.running = True
+        self.monitorThread = threading.Thread(
+            target=self.monitor, name="RenderPoolMonitor", daemon=True
+        )
+        self.monitorThread.start()
+
+    def stop(self):
+        self.running = False
+        with self.lock:
+            for worker in self.workers:
+                worker.stop()
+            self.workers = []
+
+    def spawnWorker(self):
+        worker = RenderWorker(
+            self.context,
+            self.nextIndex,
+            self.codec,
+            self.renderFunction,
+            self.maxJobs,
+            self.maxRss,
+            self.warm,
+            self.assetDirectory,
+        )
+        self.nextIndex += 1
+        return worker
+
+    @property
+    def capacity(self):
+        # Renders handled at the same time
+        return self.size
+
+    def endRestore(self):
+        # Called once the renders of the previous run are submitted again, nothing of them is
+        # left in the workers
+        pass
+
+    def getIdleWorker(self):
+        # Called with the lock held, returns None if every worker is busy or memory is short
+        busy = sum(1 for worker in self.workers if worker.render is not None)
+        if self.memoryBudget and busy > 0 and (busy + 1) * self.renderMemory > self.memoryBudget:
+            return None
+        return next((worker for worker in self.workers if worker.isIdle()), None)
+
+    def hasIdleWorker(self):
+        with self.lock:
+            return self.getIdleWorker() is not None
+
+    def submit(self, render: Render):
+        # Returns False if every worker is busy, so the render stays QUEUED
+        with self.lock:
+            worker = self.getIdleWorker()
+            if worker is None:
+                return False
+            # Set before sending the job, so a fast result can't be overwritten by INPROGRESS
+            render.setState(State.INPROGRESS)
+            try:
+                worker.assign(render)
+            except Exception as exception:
+                print(f"Error: {exception}")
+                worker.render = None
+                render.setState(State.FAILED)
+        self.notify(render)
+        return True
+
+    def cancel(self, render: Render):
+        # Kills the worker rendering it, the render engine can't be interrupted otherwise.
+        # Returns False if no worker has it
+        with self.lock:
+            worker = next((worker for worker in self.workers if worker.render is render), None)
+            if worker is None:
+                return False
+            worker.render = None
+            worker.cancelled = True
+            worker.kill()
+        return True
+
+    def setState(self, render: Render, state: State):
+        render.setState(state)
+        self.notify(render)
+
+    def notify(self, render: Render):
+        if self.onStateChange is not None:
+            try:
+                self.onStateChange(render)
+            except Exception as exception:
+                print(f"Error: {exception}")
+
+    def monitor(self):
+        while self.running:
+            with self.lock:
+                readers = {worker.resultReader: worker for worker in self.workers}
+                sentinels = {worker.process.sentinel: worker for worker in self.workers}
+            try:
+                ready = wait(list(readers) + list(sentinels), timeout=1)
+            except Exception as exception:
+                print(f"Error: {exception}")
+                continue
+            # Results go first, a worker may have finished its render right before dying
+            for handle in ready:
+                if handle in readers:
+                    self.receive(readers[handle])
+            for handle in ready:
+                if handle in sentinels:
+                    self.replace(sentinels[handle])
+
+    def receive(self, worker: RenderWorker):
+        try:
+            result = worker.resultReader.recv()
+        except (EOFError, OSError):
+            # The worker is dead, its sentinel will take care of it
+            return
+        if result[0] == READY:
+            with self.lock:
+                worker.ready = True
+            print(f"{worker.process.name} is ready after {result[1]:.1f} seconds")
+            if self.onWorkerReady is not None:
+                try:
+                    self.onWorkerReady()
+                except Exception as exception:
+                    print(f"Error: {exception}")
+            return
+        jobId, state, error, fittedFilename, usage = result
+        with self.lock:
+            render = worker.render
+            worker.render = None
+            # Set before the lock is released, so no render is handed to a worker that's exiting
+            worker.retiring = usage[3]
+        self.observeMemory(usage)
+        if render is None or render.get_id() != jobId:
+            return
+        if error is not None:
+            print(f"Error: {error}")
+        render.fittedFilename = fittedFilename
+        render.fitChecked = True
+        self.setState(render, state)
+
+    def observeMemory(self, usage):
+        rssBefore, rssAfter, peakRss, _ = usage
+        if rssAfter is None:
+            return
+        WORKER_MEMORY_BYTES.observe(rssAfter, kind="after")
+        WORKER_MEMORY_BYTES.observe(max(0, rssAfter - rssBefore), kind="growth")
+        WORKER_MEMORY_BYTES.observe(peakRss, kind="peak")
+        self.renderMemory = 0.8 * self.renderMemory + 0.2 * peakRss
+
+    def replace(self, deadWorker: RenderWorker):
+        state = State.FAILED
+        with self.lock:
+            if deadWorker not in self.workers:
+                return
+            render = deadWorker.render
+            deadWorker.render = None
+            # Keep anything the worker managed to send before it died
+            try:
+                while deadWorker.resultReader.poll():
+                    result = deadWorker.resultReader.recv()
+                    if result[0] == READY:
+                        continue
+                    jobId, sentState, error, fittedFilename, usage = result
+                    deadWorker.retiring = usage[3]
+                    if render is not None and render.get_id() == jobId:
+                        state = sentState
+                        render.fittedFilename = fittedFilename
+                        render.fitChecked = True
+            except (EOFError, OSError):
+                pass
+            deadWorker.process.join(timeout=1)
+            if deadWorker.cancelled:
+                print(f"{deadWorker.process.name} was stopped to cancel its render, respawning it")
+            elif deadWorker.retiring is not None and deadWorker.process.exitcode == 0:
+                WORKER_RECYCLES_TOTAL.inc(reason=deadWorker.retiring)
+            else:
+                print(
+                    f"Error: {deadWorker.process.name} exited with code {deadWorker.process.exitcode}, respawning it"
+                )
+            try:
+                deadWorker.jobWriter.close()
+                deadWorker.resultReader.close()
+            except Exception:
+                pass
+            index = self.workers.index(deadWorker)
+            if self.running:
+                self.workers[index] = self.spawnWorker()
+            else:
+                self.workers.pop(index)
+        if render is not None:
+            self.setState(render, state)